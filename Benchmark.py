@@ -0,0 +1,269 @@
+"""
+benchmarks of the hot paths on standard problem sizes, run by python main.py bench.
+every case is timed (best of some repeats) and then run once more under tracemalloc for
+the peak of the python and numpy allocations; the results go to a JSON file that can be
+compared with a saved baseline, to catch regressions when the loops change.
+metrics ending with _per_s are better when higher, seconds_to_theta, peak_mb and the import
+and spawn times when lower; the raw seconds are reported but not compared, they follow the
+throughputs. the startup suite also fails when a module imports at load time a heavy
+package (scipy, multiprocessing, ...) that it did not import in the baseline.
+"""
+
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Instrumentation
+
+
+def _measure(run, repeat: int):
+    """
+    :param run: function doing one run of the case and returning the dict of his counts
+    :param repeat: timed runs, the best one is kept
+    :return: (seconds, counts of the best run, peak MB of one traced run)
+    """
+    best, counts = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        if elapsed < best:
+            best, counts = elapsed, result
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, counts, peak / 2 ** 20
+
+
+def bench_bandit(quick: bool = False):
+    """
+    eps-greedy steps on the 10 armed testbed, for growing batches of parallel runs
+    """
+    from kArmedBandit import BanditEnv, BanditOptimization, bandit_experiment
+
+    steps = 1000
+    for B in ((1, 256) if quick else (1, 64, 2048)):
+        env = BanditEnv(10, num_envs=B, seed=0)
+        agent = BanditOptimization(10, B, epsilon=0.1, seed=0)
+
+        def run(env=env, agent=agent, B=B):
+            bandit_experiment(env, agent, steps)
+            return {"steps": steps * B}
+
+        yield f"bandit/B={B}", run, lambda seconds, counts: {
+            "steps_per_s": counts["steps"] / seconds}
+
+
+def bench_dp(quick: bool = False):
+    """
+    value iteration to theta on n x n gridworlds, dense for small |S| and sparse above
+    """
+    from DynamicProgr import DynamicProgramming
+    from Environments import gridworld
+
+    for n in ((10, 30) if quick else (10, 30, 100, 300)):
+        mdp = gridworld(n, n, cache_dir=None)
+
+        def run(mdp=mdp):
+            dp = DynamicProgramming(mdp, gamma=1., theta=1e-6)
+            dp.value_iteration()
+            return {"sweeps": dp.sweeps}
+
+        yield f"dp/S={n * n}", run, lambda seconds, counts: {
+            "sweeps": counts["sweeps"], "sweeps_per_s": counts["sweeps"] / seconds,
+            "seconds_to_theta": seconds}
+
+
+def bench_mc(quick: bool = False):
+    """
+    batched first visit prediction on blackjack
+    """
+    from Environments import blackjack
+    from MonteCarlo import MonteCarlo
+
+    mdp = blackjack(cache_dir=None)
+    # stick only on 20 and 21
+    policy = np.ones(mdp.num_states, dtype=int)
+    policy[:200] = (np.arange(200) // 20 + 12 < 20)
+    episodes = 20000 if quick else 100000
+
+    def run():
+        mc = MonteCarlo(mdp, max_ep_length=20, num_envs=1000, seed=0)
+        mc.batch_prediction(policy, episodes, batch_size=10000)
+        return {"episodes": episodes}
+
+    yield "mc/blackjack", run, lambda seconds, counts: {
+        "episodes_per_s": counts["episodes"] / seconds}
+
+
+def bench_td(quick: bool = False):
+    """
+    q-learning on a 10 x 10 gridworld for growing batches of lockstep environments
+    """
+    from Environments import gridworld
+    from TDlearning import TDlearning
+
+    mdp = gridworld(10, 10, cache_dir=None)
+    for B in ((1, 256) if quick else (1, 64, 4096)):
+        steps = max(100, 20000 // B) if quick else max(200, 200000 // B)
+
+        def run(B=B, steps=steps):
+            td = TDlearning(mdp, num_envs=B, alpha=0.1, epsilon=0.1, seed=0)
+            td.q_learning(steps)
+            return {"transitions": td.transitions}
+
+        yield f"td/B={B}", run, lambda seconds, counts: {
+            "transitions_per_s": counts["transitions"] / seconds}
+
+
+# the modules whose import cost is checked, and the imports they should only do lazily
+MODULES = ("Instrumentation", "kArmedBandit", "FiniteMDP", "VectorEnv", "DynamicProgr", "MonteCarlo",
+           "TDlearning", "Environments", "Trajectories", "Experiments")
+HEAVY = ("scipy", "matplotlib", "multiprocessing", "concurrent.futures", "cProfile", "pstats",
+         "tracemalloc")
+
+
+def _import_modules(names):
+    for name in names:
+        importlib.import_module(name)
+
+
+def bench_startup(quick: bool = False):
+    """
+    python -X importtime of each module in a fresh interpreter, with the heavy packages
+    it leaves imported, and the time to start a spawn pool of workers that import the
+    learners, the cost paid by every worker of the parallel sweeps
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for name in MODULES:
+        def run(name=name):
+            probe = f"import {name}, sys; print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+            process = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=here,
+                                     capture_output=True, text=True, check=True)
+            # last line of the module: "import time: self | cumulative | name", in microseconds
+            cumulative = [int(line.split("|")[1]) for line in process.stderr.splitlines()
+                          if line.rstrip().endswith(f"| {name}")][-1]
+            return {"import_us": cumulative, "heavy": process.stdout.strip()}
+
+        yield f"startup/{name}", run, lambda seconds, counts: {
+            "import_ms": counts["import_us"] / 1e3, "process_ms": seconds * 1e3,
+            "heavy_imports": counts["heavy"]}
+
+    workers = 2 if quick else 4
+
+    def spawn():
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            list(pool.map(_import_modules, [("MonteCarlo", "TDlearning")] * workers))
+        return {}
+
+    yield f"startup/spawn_{workers}_workers", spawn, lambda seconds, counts: {
+        "spawn_ms": seconds * 1e3}
+
+
+SUITES = {"startup": bench_startup, "bandit": bench_bandit, "dp": bench_dp, "mc": bench_mc,
+          "td": bench_td}
+
+
+def run_benchmarks(suites=None, quick: bool = False, repeat: int = 3, verbose: bool = True):
+    """
+    :param suites: names of SUITES to run, all by default
+    :param quick: smaller sizes, for a fast check
+    :param repeat: timed runs of each case
+    :return: dict with the machine info and the metrics of every case
+    """
+    results = {}
+    for name in suites or SUITES:
+        for case, run, metrics in SUITES[name](quick):
+            seconds, counts, peak = _measure(run, repeat)
+            results[case] = {**metrics(seconds, counts), "seconds": seconds, "peak_mb": peak}
+            if verbose:
+                print(f"{case:24s} " + "  ".join(f"{key} {value:,.4g}" if not isinstance(value, str)
+                                                else f"{key} [{value}]"
+                                                for key, value in results[case].items()))
+
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                     "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                     "quick": quick, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2):
+    """
+    regressions of report against baseline, only the cases and metrics present in both
+    :param tolerance: allowed relative change in the bad direction
+    :return: list of (case, metric, baseline value, new value)
+    """
+    regressions = []
+    for case, metrics in report["results"].items():
+        old = baseline["results"].get(case, {})
+        for metric, value in metrics.items():
+            if metric not in old:
+                continue
+            if metric == "heavy_imports":
+                # a module that starts importing a heavy package at load time
+                worse = bool(set(value.split()) - set(old[metric].split()))
+            elif old[metric] <= 0:
+                continue
+            elif metric.endswith("_per_s"):
+                worse = value < old[metric] * (1 - tolerance)
+            elif metric in ("seconds_to_theta", "peak_mb", "import_ms", "spawn_ms"):
+                worse = value > old[metric] * (1 + tolerance)
+            else:
+                continue
+            if worse:
+                regressions.append((case, metric, old[metric], value))
+
+    return regressions
+
+
+def main(args):
+    """
+    entry point of python main.py bench, see main.py for the options
+    :return: exit status, 1 if there are regressions against the baseline
+    """
+    suites = args.only.split(",") if args.only else None
+
+    if args.instrument:
+        Instrumentation.enable(trace=True)
+    with Instrumentation.profile(args.profile) if args.profile else contextlib.nullcontext():
+        report = run_benchmarks(suites, args.quick, args.repeat)
+    if args.instrument:
+        recorder = Instrumentation.disable()
+        Instrumentation.export_json(args.instrument + ".json", recorder)
+        Instrumentation.export_chrome_trace(args.instrument + ".trace.json", recorder)
+        print(f"phases written to {args.instrument}.json and {args.instrument}.trace.json")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to", args.output)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("baseline saved to", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for case, metric, old, new in regressions:
+            print(f"REGRESSION {case} {metric}: {old} -> {new}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("no regressions against", args.baseline)
+
+    return 0
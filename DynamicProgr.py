@@ -1,3 +1,13 @@
+import heapq
+import json
+import os
+
+import numpy as np
+
+import Instrumentation
+from FiniteMDP import FiniteMDPenv
+
+
 class DynamicProgramming:
     """
     Compute a optimal policies given a perfect model of the environment as a Markov Decision
@@ -118,44 +128,443 @@ class DynamicProgramming:
     But to converge correctly must update the values of all states.
 
     """
-    def __init__(self):
+    def __init__(self, mdp: FiniteMDPenv, gamma: float = 0.9, theta: float = 1e-6, seed=None):
         """
-        env variables to keep during the episode
+        :param mdp: the perfect model of the environment
+        :param gamma: discount
+        :param theta: small threshold > 0 on the largest change of a sweep
+        :param seed: seed or np.random.Generator for the arbitrary initial policy
         """
-        self.state = None
+        self.mdp = mdp
+        self.gamma = gamma
+        self.theta = theta
+        self.rng = np.random.default_rng(seed)
+
+        S, A = mdp.num_states, mdp.num_actions
+
+        # V(terminal) = 0, everything else arbitrary
+        self.V = np.zeros(S)
+        self.Q = np.zeros((S, A))
+        self.policy = masked_argmax(self.rng.random((S, A)), mdp.valid_actions)
 
-    def reset(self):
+        self.sweeps = 0
+        self.solves = 0
+        # number of single state expected updates, to compare synchronous and asynchronous DP
+        self.backups = 0
+        self.delta_history = []
+
+    def random_policy(self):
         """
-        reset env variables
-        :return: the initial values for the state for the user and the agent and the bool
-        false for the "terminal" space.
+        :return: (S, A) equiprobable policy over A(s)
         """
-        self.state = None
+        valid = self.mdp.valid_actions.astype(float)
 
-        return self.state, False
+        return valid / np.maximum(valid.sum(axis=1, keepdims=True), 1)
 
-    def step(self, action):
+    @Instrumentation.timed("dp.sweep")
+    def _sweep_values(self, V, policy=None):
         """
-        time step, from the current state, and action take reward, modify state
-        :param action: action taken by the agent
-        :return: return the new state and additional information for the user
+        one synchronous expected update of every state
+        :param policy: (S,) deterministic actions, (S, A) probabilities, or None for the max
+        :return: the new (S,) values
         """
-        reward = 0 + action, self.state
+        Q = self.mdp.action_values(V, self.gamma)
+
+        if policy is None:
+            Q[~self.mdp.valid_actions] = -np.inf
+            new_V = Q.max(axis=1)
+        elif policy.ndim == 1:
+            new_V = Q[np.arange(len(policy)), policy]
+        else:
+            new_V = np.einsum("sa,sa->s", policy, Q)
+
+        new_V[self.mdp.terminal] = 0
+
+        return new_V
+
+    def _record(self, delta: float):
+        self.sweeps += 1
+        self.backups += self.mdp.num_states
+        self.delta_history.append(delta)
+
+    def policy_evaluation(self, policy=None, V=None, max_sweeps: int = None,
+                          method: str = "iterative"):
+        """
+        policy evaluation, with the iterative sweeps or as the system of |S| linear equations
+        (I - gamma P_pi) v = r_pi, with v(terminal) = 0
+        :param policy: (S,) deterministic or (S, A) stochastic policy, the equiprobable one
+        by default
+        :param V: initial values, self.V by default
+        :param max_sweeps: stop after these sweeps even if delta >= theta (iterative only)
+        :param method: "iterative" sweeps until delta < theta, "direct" sparse LU (or dense)
+        solve, "gmres" or "bicgstab" Krylov solvers started from V
+        :return: (S,) v_pi, also kept in self.V
+        """
+        policy = self.random_policy() if policy is None else np.asarray(policy)
+        V = self.V if V is None else np.asarray(V, dtype=float)
+
+        if method != "iterative":
+            new_V = self._solve_values(policy, V, method)
+            self.solves += 1
+            self._record(float(np.max(np.abs(new_V - V), initial=0)))
+            self.V = new_V
+            return new_V
+
+        sweeps = 0
+        while max_sweeps is None or sweeps < max_sweeps:
+            new_V = self._sweep_values(V, policy)
+            delta = float(np.max(np.abs(new_V - V), initial=0))
+            V = new_V
+            sweeps += 1
+            self._record(delta)
+
+            if delta < self.theta:
+                break
+
+        self.V = V
+
+        return V
+
+    @Instrumentation.timed("dp.solve")
+    def _solve_values(self, policy, V, method: str):
+        """
+        exact v_pi from the linear system, the rows of the terminal states become v(s) = 0
+        """
+        P_pi, r_pi = self.mdp.policy_model(policy)
+        live = (~self.mdp.terminal).astype(float)
+        r_pi = r_pi * live
+        S = self.mdp.num_states
+
+        if self.mdp.sparse:
+            from scipy import sparse
+            system = (sparse.identity(S, format="csr") -
+                      self.gamma * sparse.diags(live) @ P_pi).tocsc()
+        else:
+            system = np.identity(S) - self.gamma * live[:, None] * P_pi
 
-        self.state = None, action
+        if method == "direct":
+            if self.mdp.sparse:
+                from scipy.sparse import linalg as splinalg
+                return splinalg.splu(system).solve(r_pi)
+            return np.linalg.solve(system, r_pi)
 
-        terminal = False
+        from scipy.sparse import linalg as splinalg
+        solvers = {"gmres": splinalg.gmres, "bicgstab": splinalg.bicgstab}
+        if method not in solvers:
+            raise ValueError(f"unknown policy evaluation method {method}")
 
-        return self.state, reward, terminal
+        tolerance = {"rtol": 1e-12, "atol": self.theta * 1e-3}
+        new_V, info = solvers[method](system, r_pi, x0=V, **tolerance)
+        if info != 0:
+            # a breakdown is not a bad system (bicgstab can hit one from a warm start close
+            # to the solution): again from zero, then gmres, then the direct solver
+            new_V, info = solvers[method](system, r_pi, **tolerance)
+        if info != 0 and method != "gmres":
+            new_V, info = splinalg.gmres(system, r_pi, **tolerance)
+        if info != 0:
+            if self.mdp.sparse:
+                return splinalg.splu(system).solve(r_pi)
+            return np.linalg.solve(system, r_pi)
+
+        return new_V
+
+    def policy_improvement(self, V=None, policy=None):
+        """
+        pi(s) <- argmax(a) sum(s',r) P(s',r|s,a)[r + gamma V(s')]
+        the old action is kept when it is still a maximum, so that the iteration stops on
+        policies equally good (ex. 4.4)
+        :return: the greedy (S,) policy and policy-stable
+        """
+        V = self.V if V is None else V
+        old = self.policy if policy is None else policy
+
+        return self._greedy(self.mdp.action_values(V, self.gamma), old)
+
+    def _greedy(self, Q, old):
+        Q = np.where(self.mdp.valid_actions, Q, -np.inf)
+        best = Q.max(axis=1)
+
+        new = Q.argmax(axis=1)
+        keep = Q[np.arange(len(old)), old] >= best - 1e-12
+        new[keep] = old[keep]
+
+        return new, not np.any(new != old)
+
+    def policy_iteration(self, max_iterations: int = 1000, evaluation_sweeps: int = None,
+                         method: str = "iterative"):
+        """
+        evaluation and improvement follow each others until the policy is stable.
+        with evaluation_sweeps the evaluation is cut after that number of sweeps (modified
+        policy iteration) and it stops when the policy is stable and the last sweep moved
+        the values less than theta. with an exact method each evaluation is one linear solve,
+        so a handful of solves is enough
+        :param max_iterations: maximum number of improvements
+        :param evaluation_sweeps: sweeps between each improvement, full evaluation if None
+        :param method: policy evaluation method, see policy_evaluation
+        :return: V = v* and pi = pi*
+        """
+        for _ in range(max_iterations):
+            self.policy_evaluation(self.policy, max_sweeps=evaluation_sweeps, method=method)
+            self.policy, stable = self.policy_improvement()
+            if stable and (evaluation_sweeps is None or self.delta_history[-1] < self.theta):
+                break
+
+        return self.V, self.policy
+
+    def q_policy_evaluation(self, policy=None, Q=None):
+        """
+        Q(s,a) <- sum(s',r) P(s',r|s,a)[r + gamma [sum(a') pi(a'|s') Q(s',a')]]
+        for all the pairs at once
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param Q: initial action values, self.Q by default
+        :return: (S, A) q_pi, also kept in self.Q
+        """
+        policy = self.random_policy() if policy is None else np.asarray(policy)
+        Q = self.Q if Q is None else np.asarray(Q, dtype=float)
+        terminal = self.mdp.terminal
+
+        while True:
+            if policy.ndim == 1:
+                V = Q[np.arange(len(policy)), policy]
+            else:
+                V = np.einsum("sa,sa->s", policy, Q)
+            V[terminal] = 0
+
+            new_Q = self.mdp.action_values(V, self.gamma)
+            new_Q[terminal] = 0
+            delta = float(np.max(np.abs(new_Q - Q), initial=0))
+            Q = new_Q
+            self._record(delta)
+
+            if delta < self.theta:
+                break
+
+        self.Q = Q
+
+        return Q
+
+    def action_value_policy_iteration(self, max_iterations: int = 1000):
+        """
+        policy iteration on Q, the improvement is pi(s) <- argmax(a) Q(s,a)
+        :return: Q = q* and pi = pi*
+        """
+        for _ in range(max_iterations):
+            self.q_policy_evaluation(self.policy)
+            self.policy, stable = self._greedy(self.Q, self.policy)
+            if stable:
+                break
+
+        return self.Q, self.policy
+
+    def value_iteration(self, max_sweeps: int = None, block_size: int = None,
+                        checkpoint_dir: str = None, checkpoint_every: int = 10):
+        """
+        V(s) <- max(a) sum(s',r) P(s',r|s,a)[r + gamma V(s')] for all the states each sweep
+        until delta < theta
+        with a checkpoint_dir V and pi live in np.memmap files inside it, and every
+        checkpoint_every sweeps they are flushed together with the sweep count, the delta
+        history and the rng state. calling it again on the same directory resumes from the
+        last checkpoint: V on disk can be some sweeps newer than the checkpoint, which is fine
+        since value iteration converges from any V
+        :param max_sweeps: stop after these sweeps even if delta >= theta
+        :param block_size: None for synchronous sweeps, otherwise the sweep is done in place
+        (Gauss-Seidel) on consecutive blocks of states, each block sees the values already
+        updated by the previous ones; 1 is the classic one state at a time
+        :param checkpoint_dir: directory of the memory mapped run, None to keep all in RAM
+        :param checkpoint_every: sweeps between two checkpoints
+        :return: V = v* and the deterministic greedy policy
+        """
+        if checkpoint_dir is None:
+            V, policy, converged = self.V.copy(), None, False
+        else:
+            V, policy, converged = self._open_checkpoint(checkpoint_dir)
+
+        sweeps = 0
+        while not converged and (max_sweeps is None or sweeps < max_sweeps):
+            if block_size is None:
+                new_V = self._sweep_values(V)
+                delta = float(np.max(np.abs(new_V - V), initial=0))
+                V[:] = new_V
+            else:
+                delta = self._in_place_sweep(V, block_size)
+            sweeps += 1
+            self._record(delta)
+            converged = delta < self.theta
+
+            if policy is not None and (converged or self.sweeps % checkpoint_every == 0):
+                self._save_checkpoint(checkpoint_dir, V, policy)
+
+        self.V = V
+        self.policy, _ = self.policy_improvement(V)
+        if policy is not None:
+            self._save_checkpoint(checkpoint_dir, V, policy)
+            self.policy = policy
+
+        return V, self.policy
+
+    def _open_checkpoint(self, checkpoint_dir: str):
+        """
+        memory map V and pi of the run, restoring the solver state if a checkpoint exists
+        :return: the V and pi memmaps and whether the restored run had already converged
+        """
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        state_path = os.path.join(checkpoint_dir, "checkpoint.json")
+        V_path = os.path.join(checkpoint_dir, "V.npy")
+        policy_path = os.path.join(checkpoint_dir, "policy.npy")
+
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            self.sweeps = state["sweeps"]
+            self.backups = state["backups"]
+            self.delta_history = state["delta_history"]
+            self.rng.bit_generator.state = state["rng"]
+            converged = bool(self.delta_history) and self.delta_history[-1] < self.theta
+            return (np.lib.format.open_memmap(V_path, mode="r+"),
+                    np.lib.format.open_memmap(policy_path, mode="r+"), converged)
+
+        V = np.lib.format.open_memmap(V_path, mode="w+", dtype=float, shape=self.V.shape)
+        V[:] = self.V
+        policy = np.lib.format.open_memmap(policy_path, mode="w+", dtype=np.intp,
+                                           shape=self.policy.shape)
+        policy[:] = self.policy
+
+        return V, policy, False
+
+    def _save_checkpoint(self, checkpoint_dir: str, V, policy):
+        """
+        flush V and the greedy pi, then replace the checkpoint file atomically
+        """
+        policy[:] = self.policy_improvement(V, np.asarray(policy))[0]
+        V.flush()
+        policy.flush()
+
+        state = {"sweeps": self.sweeps, "backups": self.backups,
+                 "delta_history": self.delta_history, "rng": self.rng.bit_generator.state}
+        path = os.path.join(checkpoint_dir, "checkpoint.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    @Instrumentation.timed("dp.in_place_sweep")
+    def _in_place_sweep(self, V, block_size: int):
+        """
+        one asynchronous sweep that writes every block of states directly into V
+        :return: the largest change
+        """
+        delta = 0.
+        states = np.flatnonzero(~self.mdp.terminal)
+
+        for start in range(0, len(states), block_size):
+            block = states[start:start + block_size]
+            new_v = self._backup(block, V)
+            delta = max(delta, float(np.max(np.abs(new_v - V[block]))))
+            V[block] = new_v
+
+        return delta
+
+    @Instrumentation.timed("dp.backup")
+    def _backup(self, states, V):
+        """
+        max over A(s) of the expected updates of some states
+        """
+        Q = self.mdp.state_action_values(states, V, self.gamma)
+        Q[~self.mdp.valid_actions[states]] = -np.inf
+
+        return Q.max(axis=1)
+
+    def prioritized_sweeping(self, max_backups: int = None):
+        """
+        asynchronous value iteration where the order of the updates comes from a heap of the
+        states keyed by their Bellman error |max(a) q(s,a) - V(s)|. after the backup of a
+        state only his predecessors can change error, they are found with the predecessor
+        index of the model and pushed back on the heap when their error is above theta.
+        on sparse goal directed problems most states are updated few times instead of once
+        every sweep. stale heap entries are skipped when popped. self.backups counts every
+        Bellman backup, also those that only compute the error of a state
+        :param max_backups: stop after these single state updates
+        :return: V = v* and the deterministic greedy policy
+        """
+        V = self.V.copy()
+        live = ~self.mdp.terminal
+        preds = self.mdp.predecessors()
+
+        priority = np.zeros(self.mdp.num_states)
+        states = np.flatnonzero(live)
+        priority[states] = np.abs(self._backup(states, V) - V[states])
+        self.backups += len(states)
+        heap = [(-p, s) for s, p in zip(states.tolist(), priority[states].tolist()) if p > self.theta]
+        heapq.heapify(heap)
+
+        backups = 0
+        while heap and (max_backups is None or backups < max_backups):
+            p, s = heapq.heappop(heap)
+            if -p != priority[s]:
+                continue
+
+            priority[s] = 0
+            V[s] = self._backup(np.array([s]), V)[0]
+            backups += 1
+
+            before = preds.indices[preds.indptr[s]:preds.indptr[s + 1]]
+            before = before[live[before]]
+            errors = np.abs(self._backup(before, V) - V[before])
+            self.backups += len(before)
+            raise_ = (errors > self.theta) & (errors > priority[before])
+            for state, error in zip(before[raise_].tolist(), errors[raise_].tolist()):
+                priority[state] = error
+                heapq.heappush(heap, (-error, state))
+
+        self.backups += backups
+        self.V = V
+        self.policy, _ = self.policy_improvement(V)
+
+        return V, self.policy
+
+
+def masked_argmax(values, valid):
+    """
+    argmax of every row among the valid entries only
+    :param values: (S, A) array
+    :param valid: (S, A) bool mask
+    :return: (S,) indices
+    """
+    return np.where(valid, values, -np.inf).argmax(axis=1)
 
 
 if __name__ == "__main__":
 
-    max_ep_length = 100
+    # gridworld of example 4.1, page 76: 4x4, the two corners are terminal, -1 each move
+    size = 4
+    S, A = size * size, 4
+    row, col = np.divmod(np.arange(S), size)
+    moves = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+    s = np.repeat(np.arange(S), A)
+    a = np.tile(np.arange(A), S)
+    next_row = np.clip(row[s] + moves[a, 0], 0, size - 1)
+    next_col = np.clip(col[s] + moves[a, 1], 0, size - 1)
+    terminal = np.isin(np.arange(S), [0, S - 1])
+
+    gridworld = FiniteMDPenv.from_transitions(S, A, s, a, next_row * size + next_col,
+                                              np.ones(len(s)), -np.ones(len(s)),
+                                              terminal=terminal)
 
-    obs, terminal = DynamicProgramming.reset()
+    dp = DynamicProgramming(gridworld, gamma=1., theta=1e-4)
+    print("v_pi of the equiprobable policy:")
+    print(dp.policy_evaluation().reshape(size, size).round(1))
 
-    while True:
+    dp = DynamicProgramming(gridworld, gamma=1., theta=1e-4)
+    V, pi = dp.value_iteration()
+    print("v*:")
+    print(V.reshape(size, size))
+    print("pi*:")
+    print(pi.reshape(size, size))
 
-        if terminal:
-            break
\ No newline at end of file
+    # bicgstab breaks down on this one from the warm start of the 4th evaluation
+    from Environments import gridworld as grid
+    maze = grid(30, 30, terminals=[0], cache_dir=None)
+    V, _ = DynamicProgramming(maze, gamma=0.95, theta=1e-10).policy_iteration(method="bicgstab")
+    exact, _ = DynamicProgramming(maze, gamma=0.95, theta=1e-10).value_iteration()
+    assert np.allclose(V, exact, atol=1e-8), "policy iteration with bicgstab does not reach v*"
+    print(f"30x30 policy iteration with bicgstab: max error {np.abs(V - exact).max():.1e}")
@@ -0,0 +1,409 @@
+"""
+test environments of the book as exact finite MDPs: every function returns a FiniteMDPenv,
+so the (S, A, S) model goes to DynamicProgramming and his vector_env(B) / batch_step are
+the samplers of MonteCarlo and TDlearning.
+the models are built with array operations and saved in cache_dir (memory mapped when
+loaded again), keyed by the function and his parameters; cache_dir=None always builds.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+from FiniteMDP import FiniteMDPenv
+
+
+CACHE_DIR = "env_cache"
+
+
+def _cached(name: str, params: dict, build, cache_dir: str, seed):
+    """
+    load the model of name with params from the cache, or build and save it
+    """
+    if cache_dir is None:
+        env = build()
+        env.rng = np.random.default_rng(seed)
+        return env
+
+    key = hashlib.sha1(json.dumps({"env": name, **params}, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"{name}-{key[:16]}")
+
+    if not os.path.exists(os.path.join(path, "model.json")):
+        # written aside and renamed, so parallel workers never read a half written model
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = tempfile.mkdtemp(dir=cache_dir)
+        build().save(partial)
+        try:
+            os.rename(partial, path)
+        except OSError:
+            # another process has just saved the same model
+            shutil.rmtree(partial)
+
+    return FiniteMDPenv.load(path, seed=seed)
+
+
+def gridworld(rows: int = 4, cols: int = 4, terminals=None, reward: float = -1.,
+              cache_dir: str = CACHE_DIR, seed=None):
+    """
+    gridworld of example 4.1 (pag. 76, the env to test pag. 98): moves up, down, left, right,
+    a move out of the grid leaves the state unchanged, reward -1 on every transition until
+    a terminal state. large grids (10^5 - 10^6 states) get the sparse layout
+    :param rows: rows of the grid
+    :param cols: columns of the grid
+    :param terminals: terminal state indices row * cols + col, the two opposite corners by
+    default
+    :param reward: reward of each move
+    :return: FiniteMDPenv with S = rows * cols and A = 4
+    """
+    terminals = [0, rows * cols - 1] if terminals is None else sorted(int(t) for t in terminals)
+
+    def build():
+        S, A = rows * cols, 4
+        row, col = np.divmod(np.arange(S), cols)
+        moves = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+        s = np.repeat(np.arange(S), A)
+        a = np.tile(np.arange(A), S)
+        s_next = (np.clip(row[s] + moves[a, 0], 0, rows - 1) * cols +
+                  np.clip(col[s] + moves[a, 1], 0, cols - 1))
+
+        return FiniteMDPenv.from_transitions(S, A, s, a, s_next, np.ones(len(s)),
+                                             np.full(len(s), reward),
+                                             terminal=np.isin(np.arange(S), terminals))
+
+    params = {"rows": rows, "cols": cols, "terminals": terminals, "reward": reward}
+
+    return _cached("gridworld", params, build, cache_dir, seed)
+
+
+def _poisson(lam: float, n: int):
+    """
+    pmf of 0...n-1 with the tail P(X >= n) added to n, exact when larger values are capped
+    """
+    k = np.arange(n + 1)
+    log_fact = np.concatenate([[0.], np.cumsum(np.log(np.arange(1, n + 1)))])
+    pmf = np.exp(k * np.log(lam) - lam - log_fact)
+    pmf[-1] = max(0., 1 - pmf[:-1].sum())
+
+    return pmf
+
+
+def _rental_location(max_cars: int, requests: float, returns: float):
+    """
+    one day of one location, for every number m of cars available in the morning
+    :return: (m, n') probability of having n' cars in the evening and (m,) expected rentals
+    """
+    p_req, p_ret = _poisson(requests, max_cars), _poisson(returns, max_cars)
+    m = np.arange(max_cars + 1)[:, None, None]
+    req = np.arange(max_cars + 1)[None, :, None]
+    ret = np.arange(max_cars + 1)[None, None, :]
+
+    rented = np.minimum(req, m)
+    evening = np.minimum(m - rented + ret, max_cars)
+    weight = np.broadcast_to(p_req[:, None] * p_ret[None, :], evening.shape)
+
+    size = max_cars + 1
+    index = (np.broadcast_to(m, evening.shape) * size + evening).ravel()
+    transition = np.bincount(index, weight.ravel(), size * size).reshape(size, size)
+    expected_rented = (rented[:, :, 0] * p_req).sum(axis=1)
+
+    return transition, expected_rented
+
+
+def car_rental(max_cars: int = 20, max_move: int = 5, rent: float = 10.,
+               move_cost: float = 2., requests=(3, 4), returns=(3, 2),
+               cache_dir: str = CACHE_DIR, seed=None):
+    """
+    Jack's car rental, example 4.2 pag. 81 (env to test pag. 103).
+    state (n1, n2) cars at the two locations at the end of the day, index n1 * (max_cars + 1)
+    + n2; action a moves a - max_move cars overnight from the first to the second location,
+    only if they are there; the locations then rent and get back Poisson numbers of cars,
+    independently, so p(s'|s,a) is the outer product of the two one location kernels.
+    the reward is the expected rent minus the moving cost, so sampled steps give r(s,a)
+    :return: FiniteMDPenv with S = (max_cars + 1)^2 and A = 2 max_move + 1
+    """
+    def build():
+        size = max_cars + 1
+        first, rented_1 = _rental_location(max_cars, requests[0], returns[0])
+        second, rented_2 = _rental_location(max_cars, requests[1], returns[1])
+
+        n1, n2 = np.divmod(np.arange(size * size), size)
+        move = np.arange(-max_move, max_move + 1)
+        valid = (move[None, :] <= n1[:, None]) & (-move[None, :] <= n2[:, None])
+
+        # cars in the morning, the extra ones are returned to the company
+        m1 = np.clip(n1[:, None] - move[None, :], 0, max_cars)
+        m2 = np.clip(n2[:, None] + move[None, :], 0, max_cars)
+
+        P = (first[m1][:, :, :, None] * second[m2][:, :, None, :]).reshape(size * size, len(move), -1)
+        P[~valid] = 0
+        R = rent * (rented_1[m1] + rented_2[m2]) - move_cost * np.abs(move)[None, :]
+
+        return FiniteMDPenv(P, R, valid_actions=valid)
+
+    params = {"max_cars": max_cars, "max_move": max_move, "rent": rent, "move_cost": move_cost,
+              "requests": list(requests), "returns": list(returns)}
+
+    return _cached("car_rental", params, build, cache_dir, seed)
+
+
+def gambler(goal: int = 100, p_heads: float = 0.4, cache_dir: str = CACHE_DIR, seed=None):
+    """
+    gambler's problem, example 4.3 pag. 84 (env to test pag. 106): capital s in 1...goal-1,
+    the stake a in 1...min(s, goal - s) is won with probability p_heads and lost otherwise,
+    reward +1 only when the goal is reached. states 0 and goal are terminal
+    :return: FiniteMDPenv with S = goal + 1 and A = goal // 2 + 1 (the stake 0 is never valid)
+    """
+    def build():
+        S, A = goal + 1, goal // 2 + 1
+        capital = np.arange(S)[:, None]
+        stake = np.arange(A)[None, :]
+        valid = (stake >= 1) & (stake <= np.minimum(capital, goal - capital))
+
+        s, a = np.nonzero(valid)
+        states = np.concatenate([s, s])
+        actions = np.concatenate([a, a])
+        next_states = np.concatenate([s + a, s - a])
+        probs = np.concatenate([np.full(len(s), p_heads), np.full(len(s), 1 - p_heads)])
+
+        return FiniteMDPenv.from_transitions(S, A, states, actions, next_states, probs,
+                                             next_states == goal,
+                                             terminal=np.isin(np.arange(S), [0, goal]),
+                                             valid_actions=valid)
+
+    return _cached("gambler", {"goal": goal, "p_heads": p_heads}, build, cache_dir, seed)
+
+
+# blackjack with an infinite deck: ace is 1, face cards count 10
+CARD_PROBS = np.array([1 / 13] * 9 + [4 / 13])
+
+
+@lru_cache(maxsize=None)
+def _dealer_final(total: int, usable: bool):
+    """
+    distribution of the final dealer total from a hand, the dealer hits below 17
+    :return: probabilities of 17, 18, 19, 20, 21 and bust
+    """
+    if total > 21:
+        return np.eye(6)[5]
+    if total >= 17:
+        return np.eye(6)[total - 17]
+
+    final = np.zeros(6)
+    for card, prob in enumerate(CARD_PROBS, start=1):
+        new, new_usable = _add_card(total, usable, card)
+        final += prob * _dealer_final(new, new_usable)
+
+    return final
+
+
+def _add_card(total: int, usable: bool, card: int):
+    """
+    :return: the new total and usable ace of a hand after drawing card
+    """
+    if card == 1 and total + 11 <= 21:
+        return total + 11, True
+    total += card
+    if total > 21 and usable:
+        return total - 10, False
+    return total, usable
+
+
+@lru_cache(maxsize=None)
+def _player_start(total: int, usable: bool):
+    """
+    distribution of the first decision state of the player, who always hits below 12
+    :return: dict (total, usable) -> probability
+    """
+    if total >= 12:
+        return {(total, usable): 1.}
+
+    start = {}
+    for card, prob in enumerate(CARD_PROBS, start=1):
+        for key, p in _player_start(*_add_card(total, usable, card)).items():
+            start[key] = start.get(key, 0.) + prob * p
+
+    return start
+
+
+def blackjack(cache_dir: str = CACHE_DIR, seed=None):
+    """
+    blackjack of example 5.1 pag. 93 (env pag. 115) with an infinite deck.
+    state (player total 12-21, dealer showing 1-10, usable ace), index
+    ((total - 12) * 10 + showing - 1) * 2 + usable, plus the terminal states 200 lose,
+    201 draw and 202 win, so the sampled reward is the real -1, 0, +1 of the game.
+    actions 0 stick, 1 hit. the player always hits below 12, that is in the initial
+    distribution; naturals count as a normal 21
+    :return: FiniteMDPenv with S = 203 and A = 2
+    """
+    def build():
+        lose, draw, win = 200, 201, 202
+        states, actions, next_states, probs, rewards = [], [], [], [], []
+
+        def index(total, showing, usable):
+            return ((total - 12) * 10 + showing - 1) * 2 + int(usable)
+
+        initial = np.zeros(203)
+        for showing, p_show in enumerate(CARD_PROBS, start=1):
+            dealer = _dealer_final(*_add_card(0, False, showing))
+            for (total, usable), p_start in _player_start(0, False).items():
+                initial[index(total, showing, usable)] += p_show * p_start
+
+            for total in range(12, 22):
+                for usable in (False, True):
+                    s = index(total, showing, usable)
+
+                    # stick: the dealer plays, the outcome is final
+                    p_win = dealer[5] + dealer[:5][np.arange(17, 22) < total].sum()
+                    p_draw = dealer[total - 17] if total >= 17 else 0.
+                    for outcome, p, r in ((win, p_win, 1.), (draw, p_draw, 0.),
+                                          (lose, 1 - p_win - p_draw, -1.)):
+                        if p > 0:
+                            states.append(s), actions.append(0), next_states.append(outcome)
+                            probs.append(p), rewards.append(r)
+
+                    # hit: a new card, bust is a loss
+                    for card, p in enumerate(CARD_PROBS, start=1):
+                        new, new_usable = _add_card(total, usable, card)
+                        bust = new > 21
+                        states.append(s), actions.append(1), probs.append(p)
+                        next_states.append(lose if bust else index(new, showing, new_usable))
+                        rewards.append(-1. if bust else 0.)
+
+        return FiniteMDPenv.from_transitions(203, 2, states, actions, next_states, probs, rewards,
+                                             terminal=np.arange(203) >= 200, initial=initial)
+
+    return _cached("blackjack", {}, build, cache_dir, seed)
+
+
+# small track in the spirit of figure 5.5: start S at the bottom, finish F on the right
+RACETRACK = (
+    "###..........F",
+    "##...........F",
+    "##...........F",
+    "#............F",
+    "#.......######",
+    "#......#######",
+    "#......#######",
+    "#......#######",
+    "##.....#######",
+    "##.....#######",
+    "##.....#######",
+    "###....#######",
+    "###....#######",
+    "###SSSS#######",
+)
+
+
+def racetrack(track=RACETRACK, max_speed: int = 4, noise: float = 0.1,
+              cache_dir: str = CACHE_DIR, seed=None):
+    """
+    racetrack of exercise 5.12 pag. 111: state (cell, vertical speed up, horizontal speed
+    right), both speeds in 0...max_speed-1 and not both zero out of the start line. the 9
+    actions change each speed by -1, 0 or +1, with probability noise both changes are zero.
+    reward -1 per step; the car finishes when his path crosses F, and goes back to a random
+    start cell with speed zero when it leaves the track. the last state is the terminal one
+    :param track: rows of the track, '#' outside, '.' track, 'S' start line, 'F' finish line
+    :return: FiniteMDPenv with S = cells * max_speed^2 + 1 and A = 9
+    """
+    def build():
+        grid = np.array([list(line) for line in track])
+        cell_rows, cell_cols = np.nonzero(grid != "#")
+        cells = len(cell_rows)
+        cell_index = np.full(grid.shape, -1)
+        cell_index[cell_rows, cell_cols] = np.arange(cells)
+        starts = cell_index[grid == "S"]
+
+        speeds = max_speed * max_speed
+        S, A, terminal = cells * speeds + 1, 9, cells * speeds
+        cell, vy, vx = np.unravel_index(np.arange(S - 1), (cells, max_speed, max_speed))
+        dvy, dvx = np.divmod(np.arange(A), 3)
+
+        # the two outcomes of each (s, a): the chosen changes, or none with p = noise
+        s = np.repeat(np.arange(S - 1), 2 * A)
+        a = np.tile(np.repeat(np.arange(A), 2), S - 1)
+        applied = np.tile([1, 0], (S - 1) * A)
+        p = np.where(applied == 1, 1 - noise, noise)
+
+        new_vy = np.clip(vy[s] + applied * (dvy[a] - 1), 0, max_speed - 1)
+        new_vx = np.clip(vx[s] + applied * (dvx[a] - 1), 0, max_speed - 1)
+        stopped = (new_vy == 0) & (new_vx == 0) & (grid[cell_rows[cell[s]], cell_cols[cell[s]]] != "S")
+        new_vy[stopped], new_vx[stopped] = vy[s][stopped], vx[s][stopped]
+
+        # points along the path, the first one out of the track or on the finish decides
+        n = 2 * (max_speed - 1)
+        f = np.arange(1, n + 1)[None, :] / n
+        path_r = np.rint(cell_rows[cell[s]][:, None] - f * new_vy[:, None]).astype(int)
+        path_c = np.rint(cell_cols[cell[s]][:, None] + f * new_vx[:, None]).astype(int)
+        inside = (path_r >= 0) & (path_r < grid.shape[0]) & (path_c >= 0) & (path_c < grid.shape[1])
+        symbol = np.where(inside, grid[np.clip(path_r, 0, grid.shape[0] - 1),
+                                       np.clip(path_c, 0, grid.shape[1] - 1)], "#")
+        event = (symbol == "F") | (symbol == "#")
+        first = event.argmax(axis=1)
+        finished = event.any(axis=1) & (symbol[np.arange(len(s)), first] == "F")
+        crashed = event.any(axis=1) & ~finished
+
+        end = cell_index[path_r[:, -1].clip(0, grid.shape[0] - 1), path_c[:, -1].clip(0, grid.shape[1] - 1)]
+        next_states = np.where(finished, terminal,
+                               np.ravel_multi_index((end, new_vy, new_vx), (cells, max_speed, max_speed),
+                                                    mode="clip"))
+
+        # a crash goes to every start cell with speed zero
+        moving = ~crashed
+        crash_s = np.repeat(s[crashed], len(starts))
+        crash_a = np.repeat(a[crashed], len(starts))
+        crash_p = np.repeat(p[crashed], len(starts)) / len(starts)
+        crash_next = np.tile(starts * speeds, np.count_nonzero(crashed))
+
+        states = np.concatenate([s[moving], crash_s])
+        actions = np.concatenate([a[moving], crash_a])
+        probs = np.concatenate([p[moving], crash_p])
+        next_all = np.concatenate([next_states[moving], crash_next])
+
+        initial = np.zeros(S)
+        initial[starts * speeds] = 1
+
+        return FiniteMDPenv.from_transitions(S, A, states, actions, next_all, probs,
+                                             -np.ones(len(states)),
+                                             terminal=np.arange(S) == terminal, initial=initial)
+
+    params = {"track": list(track), "max_speed": max_speed, "noise": noise}
+
+    return _cached("racetrack", params, build, cache_dir, seed)
+
+
+if __name__ == "__main__":
+    import time
+
+    from DynamicProgr import DynamicProgramming
+    from MonteCarlo import MonteCarlo
+
+    for name, build, gamma in (("gridworld", gridworld, 1.), ("car rental", car_rental, 0.9),
+                               ("gambler", gambler, 1.), ("blackjack", blackjack, 1.),
+                               ("racetrack", racetrack, 1.)):
+        start = time.perf_counter()
+        env = build(cache_dir=None)
+        built = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dp = DynamicProgramming(env, gamma=gamma, theta=1e-6)
+        V, pi = dp.value_iteration()
+        solved = time.perf_counter() - start
+
+        print(f"{name}: {env.num_states} states, {env.num_actions} actions, built in {built:.2f}s, "
+              f"value iteration {dp.sweeps} sweeps in {solved:.2f}s, "
+              f"v* of the start {env.initial @ V:.3f}")
+
+    # blackjack by sampling: MC prediction of the policy sticking only on 20 and 21
+    env = blackjack(cache_dir=None, seed=0)
+    stick_20 = np.ones(env.num_states, dtype=int)
+    stick_20[:200] = ((np.arange(200) // 20) + 12 < 20).astype(int)
+    mc = MonteCarlo(env, max_ep_length=20, num_envs=1000, seed=0)
+    V = mc.batch_prediction(stick_20, 100000, batch_size=10000)
+    print("blackjack, stick on 20: mean start value by MC", round(float(env.initial @ V), 3),
+          "exact", round(float(env.initial @ DynamicProgramming(env, 1.).policy_evaluation(stick_20)), 3))
@@ -0,0 +1,272 @@
+"""
+experiment runner of python main.py run config.json.
+the config is a list of experiments, each one an algorithm on an environment with fixed
+params, a grid of params (every combination is run) and a list of seeds:
+
+{"experiments": [
+    {"algorithm": "bandit", "env": "testbed", "env_params": {"k": 10},
+     "params": {"agent": "eps-greedy", "steps": 1000, "runs": 2000},
+     "grid": {"epsilon": [0, 0.01, 0.1]}, "seeds": [0, 1, 2]},
+    {"algorithm": "q_learning", "env": "gridworld", "env_params": {"rows": 10, "cols": 10},
+     "params": {"steps": 2000, "num_envs": 64}, "grid": {"alpha": [0.1, 0.5]}, "seeds": [0]}
+]}
+
+every (experiment, grid point, seed) is a job identified by the hash of his content; the
+jobs run on a process pool with at most a bounded number of them submitted at once, and
+each finished job is appended to a JSONL manifest. running the same config again skips
+the jobs already in the manifest, so an interrupted sweep only does the missing work.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+
+def _bandit_env(k: int = 10, nonstationary: bool = False, seed=None, **kwargs):
+    from kArmedBandit import BanditEnv, NonStationaryBanditEnv
+
+    return (NonStationaryBanditEnv if nonstationary else BanditEnv)(n=k, seed=seed, **kwargs)
+
+
+def _book_env(name: str):
+    def build(seed=None, **params):
+        import Environments
+        return getattr(Environments, name)(seed=seed, **params)
+    return build
+
+
+# env name -> function (seed, **env_params) -> environment
+ENVIRONMENTS = {
+    "testbed": _bandit_env,
+    "nonstationary": lambda seed=None, **params: _bandit_env(nonstationary=True, seed=seed, **params),
+    **{name: _book_env(name) for name in ("gridworld", "car_rental", "gambler", "blackjack",
+                                          "racetrack")},
+}
+
+
+def run_bandit(env_name: str, env_params: dict, params: dict, seeds):
+    from kArmedBandit import BANDIT_AGENTS, bandit_experiment
+
+    params = dict(params)
+    agent, steps, runs = params.pop("agent", "eps-greedy"), params.pop("steps", 1000), params.pop("runs", 2000)
+    env = ENVIRONMENTS[env_name](seed=seeds[0], num_envs=runs, **env_params)
+    agent_class, fixed = BANDIT_AGENTS[agent]
+    bandit = agent_class(n=env.rand_mean_vector.shape[1], num_envs=runs, seed=seeds[1],
+                         **{**fixed, **params})
+
+    avg_reward, optimal_action = bandit_experiment(env, bandit, steps)
+
+    return {"average_reward": float(avg_reward.mean()), "final_reward": float(avg_reward[-1]),
+            "optimal_action": float(optimal_action[-1])}
+
+
+def run_dp(method: str):
+    def run(env_name: str, env_params: dict, params: dict, seeds):
+        from DynamicProgr import DynamicProgramming
+
+        params = dict(params)
+        mdp = ENVIRONMENTS[env_name](seed=seeds[0], **env_params)
+        dp = DynamicProgramming(mdp, gamma=params.pop("gamma", 0.9), theta=params.pop("theta", 1e-6),
+                                seed=seeds[1])
+        V, policy = getattr(dp, method)(**params)
+
+        return {"start_value": float(mdp.initial @ V), "sweeps": dp.sweeps, "backups": dp.backups}
+    return run
+
+
+def run_mc_control(env_name: str, env_params: dict, params: dict, seeds):
+    from MonteCarlo import MonteCarlo
+
+    params = dict(params)
+    mdp = ENVIRONMENTS[env_name](seed=seeds[0], **env_params)
+    mc = MonteCarlo(mdp, gamma=params.pop("gamma", 1.), epsilon=params.pop("epsilon", 0.1),
+                    max_ep_length=params.pop("max_ep_length", 1000),
+                    num_envs=params.pop("num_envs", 64), seed=seeds[1])
+    Q, policy = mc.batch_control(params.pop("episodes", 10000), **params)
+
+    return {"start_value": float(mdp.initial @ Q.max(axis=1))}
+
+
+def run_td(method: str):
+    def run(env_name: str, env_params: dict, params: dict, seeds):
+        from TDlearning import TDlearning
+
+        params = dict(params)
+        mdp = ENVIRONMENTS[env_name](seed=seeds[0], **env_params)
+        td = TDlearning(mdp, num_envs=params.pop("num_envs", 1), alpha=params.pop("alpha", 0.1),
+                        gamma=params.pop("gamma", 1.), epsilon=params.pop("epsilon", 0.1),
+                        seed=seeds[1])
+        Q = getattr(td, method)(params.pop("steps", 1000), **params)
+        returns = td.episode_returns[-100:]
+
+        return {"start_value": float(mdp.initial @ Q.max(axis=1)), "episodes": td.env.episodes_finished,
+                "last_returns": float(np.mean(returns)) if len(returns) else None}
+    return run
+
+
+# algorithm name -> function (env name, env params, params, (env seed, agent seed)) -> metrics
+ALGORITHMS = {
+    "bandit": run_bandit,
+    "value_iteration": run_dp("value_iteration"),
+    "policy_iteration": run_dp("policy_iteration"),
+    "prioritized_sweeping": run_dp("prioritized_sweeping"),
+    "mc_control": run_mc_control,
+    "sarsa": run_td("sarsa"),
+    "q_learning": run_td("q_learning"),
+    "expected_sarsa": run_td("expected_sarsa"),
+}
+
+
+def expand(config: dict):
+    """
+    :param config: dict with the list of experiments, see the module docstring
+    :return: list of jobs, one for every grid point and seed, each with his key
+    """
+    jobs = []
+    for experiment in config["experiments"]:
+        if experiment["algorithm"] not in ALGORITHMS:
+            raise ValueError(f"unknown algorithm {experiment['algorithm']}")
+        if experiment["env"] not in ENVIRONMENTS:
+            raise ValueError(f"unknown env {experiment['env']}")
+
+        grid = experiment.get("grid", {})
+        for values in itertools.product(*grid.values()):
+            for seed in experiment.get("seeds", [0]):
+                job = {"algorithm": experiment["algorithm"], "env": experiment["env"],
+                       "env_params": experiment.get("env_params", {}),
+                       "params": {**experiment.get("params", {}), **dict(zip(grid, values))},
+                       "seed": seed}
+                job["key"] = hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+                jobs.append(job)
+
+    return jobs
+
+
+def run_job(job: dict):
+    """
+    one job, run inside a worker process. the env and the agent get two independent
+    streams of the job seed
+    :return: manifest record of the job
+    """
+    seeds = [np.random.default_rng(s) for s in np.random.SeedSequence(job["seed"]).spawn(2)]
+
+    start = time.perf_counter()
+    result = ALGORITHMS[job["algorithm"]](job["env"], job["env_params"], job["params"], seeds)
+
+    return {**job, "result": result, "seconds": time.perf_counter() - start,
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def load_manifest(path: str):
+    """
+    :return: key -> record of the finished jobs; a truncated last line (crash while
+    writing) is ignored
+    """
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["key"]] = record
+
+    return records
+
+
+def run_experiments(config: dict, manifest: str = "manifest.jsonl", max_workers: int = None,
+                    max_pending: int = None, verbose: bool = True):
+    """
+    run the jobs of config that are not in the manifest yet
+    :param config: dict of the experiments
+    :param manifest: JSONL file, one record for each finished job
+    :param max_workers: size of the process pool, the number of cpus by default
+    :param max_pending: jobs submitted at once, 2 * max_workers by default, so a large
+    grid is not queued all together in memory
+    :return: key -> record of the finished jobs of config, the failed ones are missing
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    jobs = expand(config)
+    done = load_manifest(manifest)
+    todo = iter([job for job in jobs if job["key"] not in done])
+    if verbose:
+        print(f"{len(jobs)} jobs, {len(jobs) - sum(job['key'] in done for job in jobs)} to run")
+
+    max_workers = max_workers or os.cpu_count()
+    max_pending = max_pending or 2 * max_workers
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool, open(manifest, "a") as log:
+        pending, failed = set(), 0
+        while True:
+            for job in itertools.islice(todo, max_pending - len(pending)):
+                pending.add(pool.submit(run_job, job))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    record = future.result()
+                except Exception as error:
+                    # not written to the manifest, the next run tries it again
+                    failed += 1
+                    print(f"job failed: {error!r}")
+                    continue
+                log.write(json.dumps(record) + "\n")
+                log.flush()
+                done[record["key"]] = record
+                if verbose:
+                    print(f"{record['algorithm']} on {record['env']} {record['params']} "
+                          f"seed {record['seed']}: {record['result']} ({record['seconds']:.2f}s)")
+
+    if failed and verbose:
+        print(f"{failed} jobs failed, run again to retry them")
+
+    return {job["key"]: done[job["key"]] for job in jobs if job["key"] in done}
+
+
+def summarize(records):
+    """
+    mean and std over the seeds of every numeric metric, for each algorithm, env and params
+    :return: list of (algorithm, env, env params, params, metric -> (mean, std, seeds))
+    """
+    groups = {}
+    for record in records:
+        name = json.dumps([record["algorithm"], record["env"], record["env_params"],
+                           record["params"]], sort_keys=True)
+        groups.setdefault(name, []).append(record["result"])
+
+    summary = []
+    for name, results in groups.items():
+        metrics = {}
+        for metric in results[0]:
+            values = [r[metric] for r in results if isinstance(r.get(metric), (int, float))]
+            if values:
+                metrics[metric] = (float(np.mean(values)), float(np.std(values)), len(values))
+        summary.append((*json.loads(name), metrics))
+
+    return summary
+
+
+def main(args):
+    """
+    entry point of python main.py run, see main.py for the options
+    """
+    with open(args.config) as f:
+        config = json.load(f)
+
+    records = run_experiments(config, args.manifest, args.workers, args.max_pending)
+    missing = len(expand(config)) - len(records)
+
+    for algorithm, env, env_params, params, metrics in summarize(records.values()):
+        print(f"{algorithm} on {env} {env_params or ''} {params}: " +
+              ", ".join(f"{metric} {mean:.4g} +- {std:.2g} ({n} seeds)"
+                        for metric, (mean, std, n) in metrics.items()))
+
+    return 1 if missing else 0
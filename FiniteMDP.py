@@ -1,3 +1,18 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from VectorEnv import MDPVectorEnv
+
+
+def _issparse(matrix):
+    # a scipy sparse matrix can exist only once scipy.sparse is imported, so the check
+    # never imports it
+    return "scipy.sparse" in sys.modules and sys.modules["scipy.sparse"].issparse(matrix)
+
+
 class FiniteMDPenv:
     """
     over discrete time steps
@@ -63,44 +78,372 @@ class FiniteMDPenv:
     the methods are the one to approximate these functions
 
     """
-    def __init__(self):
+    def __init__(self, transitions, rewards, terminal=None, initial=None, valid_actions=None,
+                 seed=None):
         """
-        env variables to keep during the episode
+        tabular model of the dynamics, shared by DP (expected updates) and by MC and TD (samples)
+        :param transitions: p(s'|s,a) as a dense (S, A, S) array, or as a scipy sparse matrix of
+        shape (S * A, S) with row s * A + a, for large and mostly zero state spaces
+        :param rewards: expected reward r(s,a) as a (S, A) array, or the reward of every
+        transition r(s,a,s') with the same layout of transitions
+        :param terminal: (S,) bool mask of the terminal states, where the episodes end
+        :param initial: (S,) distribution of S0, uniform over the non terminal states by default
+        :param valid_actions: (S, A) bool mask of A(s), all actions everywhere by default
+        :param seed: seed or np.random.Generator for the sampled steps
         """
+        self.sparse = _issparse(transitions)
+
+        if self.sparse:
+            self.P = transitions.tocsr().astype(float)
+            self.P.sum_duplicates()
+            self.P.sort_indices()
+            self.num_states = self.P.shape[1]
+            self.num_actions = self.P.shape[0] // self.num_states
+        else:
+            self.P = np.asarray(transitions, dtype=float)
+            self.num_states, self.num_actions = self.P.shape[:2]
+
+        S, A = self.num_states, self.num_actions
+
+        self.terminal = np.zeros(S, dtype=bool) if terminal is None else np.asarray(terminal, bool)
+        self.valid_actions = (np.ones((S, A), dtype=bool) if valid_actions is None
+                              else np.asarray(valid_actions, dtype=bool))
+
+        if initial is None:
+            initial = (~self.terminal).astype(float)
+        self.initial = np.asarray(initial, dtype=float) / np.sum(initial)
+        self._initial_cdf = np.cumsum(self.initial)
+        self._initial_cdf[-1] = 1.
+
+        self.rng = np.random.default_rng(seed)
         self.state = None
 
-    def reset(self):
+        self._build_sampler(rewards)
+
+    def _build_sampler(self, rewards):
+        """
+        flatten the nonzero p(s'|s,a) by row s * A + a and build a global cdf where the row i
+        goes from i to i + 1, so a whole batch of next states is one searchsorted.
+        it also computes the expected reward r(s,a) when rewards of transitions are given
+        """
+        S, A = self.num_states, self.num_actions
+
+        if self.sparse:
+            rows = np.repeat(np.arange(S * A), np.diff(self.P.indptr))
+            cols = self.P.indices
+            probs = self.P.data
+        else:
+            rows, cols = np.nonzero(self.P.reshape(S * A, S))
+            probs = self.P.reshape(S * A, S)[rows, cols]
+
+        rewards = rewards.tocsr() if _issparse(rewards) else np.asarray(rewards, dtype=float)
+        if rewards.shape == (S, A):
+            self.R = rewards.copy()
+            entry_rewards = None
+        else:
+            if _issparse(rewards):
+                entry_rewards = np.asarray(rewards[rows, cols]).ravel()
+            else:
+                entry_rewards = rewards.reshape(S * A, S)[rows, cols]
+            self.R = np.bincount(rows, probs * entry_rewards, S * A).reshape(S, A)
+
+        totals = np.bincount(rows, probs, S * A)
+        missing = totals == 0
+        if np.any(np.abs(totals[~missing] - 1) > 1e-8):
+            raise ValueError("p(s'|s,a) must sum to 1 over s' for every (s, a)")
+
+        # (s, a) without dynamics (terminal states, actions out of A(s)) loop on s
+        if np.any(missing):
+            extra = np.flatnonzero(missing)
+            order = np.argsort(np.concatenate([rows, extra]), kind="stable")
+            rows = np.concatenate([rows, extra])[order]
+            cols = np.concatenate([cols, extra // A])[order]
+            probs = np.concatenate([probs, np.ones(len(extra))])[order]
+            if entry_rewards is not None:
+                entry_rewards = np.concatenate([entry_rewards, np.zeros(len(extra))])[order]
+            totals[missing] = 1
+
+        cdf = np.cumsum(probs)
+        ends = np.cumsum(np.bincount(rows, minlength=S * A))
+        before = np.concatenate([[0.], cdf[ends[:-1] - 1]])
+        cdf -= before[rows]
+        cdf /= totals[rows]
+        cdf[ends - 1] = 1.
+
+        self._cdf = cdf + rows
+        self._row_end = ends
+        self._next_states = cols
+        self._rewards = entry_rewards
+
+    def reset(self, num: int = None, rng=None):
         """
         reset env variables
+        :param num: number of parallel episodes to start, a single one if None
+        :param rng: np.random.Generator to use instead of self.rng
         :return: the initial values for the state for the user and the agent and the bool
         false for the "terminal" space.
         """
-        self.state = None
+        rng = self.rng if rng is None else rng
+
+        if num is None:
+            self.state = int(np.searchsorted(self._initial_cdf, rng.random(), side="right"))
+            return self.state, False
 
-        return self.state, False
+        states = np.searchsorted(self._initial_cdf, rng.random(num), side="right")
+
+        return states, self.terminal[states]
 
     def step(self, action):
         """
         time step, from the current state, and action take reward, modify state
         :param action: action taken by the agent
-        :return: return the new state and additional information for the user
+        :return: return the new state, the reward and if the new state is terminal
+        """
+        state, reward, terminal = self.batch_step(np.array([self.state]), np.array([action]))
+        self.state = int(state[0])
+
+        return self.state, float(reward[0]), bool(terminal[0])
+
+    def batch_step(self, states, actions, rng=None):
+        """
+        one sampled transition for many parallel episodes at once
+        :param states: (n,) current states
+        :param actions: (n,) actions taken in them
+        :param rng: np.random.Generator to use instead of self.rng
+        :return: (n,) next states, rewards and terminal flags
+        """
+        rng = self.rng if rng is None else rng
+
+        rows = states * self.num_actions + actions
+        idx = np.searchsorted(self._cdf, rows + rng.random(len(rows)), side="right")
+        np.minimum(idx, self._row_end[rows] - 1, out=idx)
+
+        next_states = self._next_states[idx]
+        rewards = self.R[states, actions] if self._rewards is None else self._rewards[idx]
+
+        return next_states, rewards, self.terminal[next_states]
+
+    def vector_env(self, num_envs: int = 1, seed=None):
+        """
+        :param num_envs: number of parallel episodes B
+        :param seed: seed or np.random.Generator of the vector env
+        :return: MDPVectorEnv with B episodes of this model
+        """
+        return MDPVectorEnv(self, num_envs, seed)
+
+    def action_values(self, V, gamma: float):
+        """
+        expected update of every state action pair in one tensor operation
+        q(s,a) = r(s,a) + gamma sum(s') p(s'|s,a) V(s')
+        :param V: (S,) state values
+        :param gamma: discount
+        :return: (S, A) action values
         """
-        reward = 0 + action, self.state
+        PV = self.P @ V
+        if self.sparse:
+            PV = PV.reshape(self.num_states, self.num_actions)
+
+        PV *= gamma
+        PV += self.R
 
-        self.state = None, action
+        return PV
 
-        terminal = False
+    def state_action_values(self, states, V, gamma: float):
+        """
+        expected update of the pairs of some states only, for the in place and asynchronous DP
+        :param states: (n,) states
+        :param V: (S,) state values
+        :param gamma: discount
+        :return: (n, A) action values
+        """
+        if self.sparse:
+            # gather the CSR rows by hand, slicing the matrix costs more than the product
+            rows = (states[:, None] * self.num_actions + np.arange(self.num_actions)).ravel()
+            starts = self.P.indptr[rows]
+            lengths = self.P.indptr[rows + 1] - starts
+            offsets = np.cumsum(lengths) - lengths
+            entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+            PV = np.bincount(np.repeat(np.arange(len(rows)), lengths),
+                             self.P.data[entries] * V[self.P.indices[entries]], len(rows))
+            PV = PV.reshape(len(states), self.num_actions)
+        else:
+            PV = self.P[states] @ V
 
-        return self.state, reward, terminal
+        PV *= gamma
+        PV += self.R[states]
+
+        return PV
+
+    def predecessors(self):
+        """
+        index of the states that can lead to each state with some action
+        :return: (S, S) CSR matrix, the row s' holds the s with p(s'|s,a) > 0 for some a
+        """
+        from scipy import sparse
+
+        S, A = self.num_states, self.num_actions
+        rows = np.repeat(np.arange(S * A), np.diff(self._row_end, prepend=0))
+        index = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (self._next_states, rows // A)),
+                                  shape=(S, S))
+        index.sum_duplicates()
+
+        return index
+
+    def policy_model(self, policy):
+        """
+        dynamics and rewards of the Markov chain followed under a policy
+        P_pi(s, s') = sum(a) pi(a|s) p(s'|s,a) and r_pi(s) = sum(a) pi(a|s) r(s,a)
+        :param policy: (S,) deterministic actions or (S, A) probabilities
+        :return: P_pi, (S, S) dense array or CSR matrix as the model, and the (S,) r_pi
+        """
+        S, A = self.num_states, self.num_actions
+        policy = np.asarray(policy)
+        states = np.arange(S)
+
+        if policy.ndim == 1:
+            r_pi = self.R[states, policy]
+            if self.sparse:
+                return self.P[states * A + policy], r_pi
+            return self.P[states, policy], r_pi
+
+        r_pi = np.einsum("sa,sa->s", policy, self.R)
+        if self.sparse:
+            from scipy import sparse
+            weights = sparse.csr_matrix((policy.ravel(), (np.repeat(states, A), np.arange(S * A))),
+                                        shape=(S, S * A))
+            return (weights @ self.P).tocsr(), r_pi
+
+        return np.einsum("sa,sat->st", policy, self.P), r_pi
+
+    # arrays written by save, the sampler ones included so that load does not rebuild them
+    _saved_arrays = ("R", "terminal", "valid_actions", "initial", "_initial_cdf", "_cdf",
+                     "_row_end", "_next_states", "_rewards")
+
+    def save(self, directory: str):
+        """
+        write the model as .npy files that load can memory map
+        :param directory: destination, created if missing
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        arrays = {name: getattr(self, name) for name in self._saved_arrays
+                  if getattr(self, name) is not None}
+        if self.sparse:
+            arrays.update(P_data=self.P.data, P_indices=self.P.indices, P_indptr=self.P.indptr)
+        else:
+            arrays["P"] = self.P
+
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+
+        with open(os.path.join(directory, "model.json"), "w") as f:
+            json.dump({"sparse": self.sparse, "num_states": self.num_states,
+                       "num_actions": self.num_actions}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str = "r", seed=None):
+        """
+        open a model written by save. with the default read only memory map the arrays are
+        not copied in RAM, so many worker processes share the same pages of the os cache
+        :param directory: the saved model
+        :param mmap_mode: np.load mmap_mode, None to read everything in memory
+        :param seed: seed or np.random.Generator for the sampled steps
+        :return: the FiniteMDPenv
+        """
+        with open(os.path.join(directory, "model.json")) as f:
+            meta = json.load(f)
+
+        def array(name):
+            path = os.path.join(directory, name + ".npy")
+            return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+
+        env = cls.__new__(cls)
+        env.sparse = meta["sparse"]
+        env.num_states = meta["num_states"]
+        env.num_actions = meta["num_actions"]
+
+        if env.sparse:
+            from scipy import sparse
+            shape = (env.num_states * env.num_actions, env.num_states)
+            env.P = sparse.csr_matrix(shape)
+            env.P.data, env.P.indices, env.P.indptr = (array("P_data"), array("P_indices"),
+                                                       array("P_indptr"))
+        else:
+            env.P = array("P")
+
+        for name in cls._saved_arrays:
+            setattr(env, name, array(name))
+
+        env.rng = np.random.default_rng(seed)
+        env.state = None
+
+        return env
+
+    @classmethod
+    def from_transitions(cls, num_states: int, num_actions: int, states, actions, next_states,
+                         probs, rewards, dense: bool = None, **kwargs):
+        """
+        build the model from the list of the dynamics p(s',r|s,a), one entry for each
+        (s, a, s', r) with nonzero probability; entries with the same (s, a, s') are merged
+        and keep their expected reward
+        :param dense: force the dense (S, A, S) layout or the sparse one, by default dense
+        when the tensor has less than 2**24 entries
+        :return: the FiniteMDPenv
+        """
+        rows = np.asarray(states) * num_actions + np.asarray(actions)
+        probs = np.asarray(probs, dtype=float)
+        shape = (num_states * num_actions, num_states)
+
+        if dense is None:
+            dense = num_states * num_actions * num_states < 2 ** 24
+
+        if dense:
+            # summed with bincount, the small models never need scipy
+            index = rows * num_states + np.asarray(next_states)
+            P = np.bincount(index, probs, shape[0] * shape[1])
+            R = np.bincount(index, probs * rewards, shape[0] * shape[1])
+            np.divide(R, P, out=R, where=P > 0)
+            shape = (num_states, num_actions, num_states)
+            return cls(P.reshape(shape), R.reshape(shape), **kwargs)
+
+        from scipy import sparse
+        P = sparse.csr_matrix((probs, (rows, next_states)), shape=shape)
+        PR = sparse.csr_matrix((probs * rewards, (rows, next_states)), shape=shape)
+        R = PR.multiply(P.power(-1)).tocsr()
+
+        return cls(P, R, **kwargs)
 
 
 if __name__ == "__main__":
 
     max_ep_length = 100
 
-    obs, terminal = FiniteMDPenv.reset()
+    # random walk of page 125: states 0 and 6 are terminal, reward 1 on the right end
+    S, A = 7, 2
+    s = np.repeat(np.arange(1, 6), 2)
+    a = np.tile([0, 1], 5)
+    s_next = s + 2 * a - 1
+    env = FiniteMDPenv.from_transitions(S, A, s, a, s_next, np.ones(10), s_next == 6,
+                                        terminal=np.isin(np.arange(S), [0, 6]),
+                                        initial=np.eye(S)[3], seed=0)
 
-    while True:
+    obs, terminal = env.reset()
+    trajectory = [obs]
+
+    for _ in range(max_ep_length):
+        obs, reward, terminal = env.step(env.rng.integers(A))
+        trajectory += [reward, obs]
 
         if terminal:
-            break
\ No newline at end of file
+            break
+
+    print("episode:", trajectory)
+
+    # the same walk as 1000 parallel episodes, with auto-reset of the finished ones
+    walks = env.vector_env(1000, seed=0)
+    walks.reset()
+    for _ in range(max_ep_length):
+        walks.step(walks.rng.integers(A, size=1000))
+
+    print(f"{walks.episodes_finished} episodes finished, fraction ended on the right "
+          f"{walks.returns_sum / walks.episodes_finished:.3f}")
@@ -0,0 +1,199 @@
+"""
+opt-in instrumentation of the hot loops. the methods are decorated with timed(name) and
+count(name, n) marks units of work; while disabled (the default) timed costs one function
+call and a None check, count only the None check, nothing is stored.
+
+    Instrumentation.enable(trace=True)
+    ... run ...
+    Instrumentation.export_json("summary.json")
+    Instrumentation.export_chrome_trace("trace.json")   # chrome://tracing or ui.perfetto.dev
+
+every phase keeps calls, total and max time and a histogram of his durations in power of 2
+buckets of microseconds; with trace=True every call is also an event of the Chrome trace,
+up to max_events.
+"""
+
+import contextlib
+import functools
+import io
+import json
+import os
+import threading
+import time
+
+
+# the active recorder, None when disabled
+_recorder = None
+
+
+class Recorder:
+    def __init__(self, trace: bool = False, max_events: int = 1000000):
+        self.counters = {}
+        # phase -> [calls, total ns, max ns, histogram of log2 microseconds]
+        self.timers = {}
+        self.trace = trace
+        self.max_events = max_events
+        self.events = []
+        self.start = time.perf_counter_ns()
+
+    def record(self, name: str, start: int, end: int):
+        elapsed = end - start
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0, 0, [0] * 40]
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
+        timer[3][min((elapsed // 1000).bit_length(), 39)] += 1
+
+        if self.trace and len(self.events) < self.max_events:
+            self.events.append((name, start, elapsed, threading.get_ident()))
+
+
+def enable(trace: bool = False, max_events: int = 1000000):
+    """
+    start recording, from empty counters
+    :param trace: also keep every call as a Chrome trace event
+    :param max_events: events kept at most, the later ones are dropped
+    """
+    global _recorder
+    _recorder = Recorder(trace, max_events)
+
+
+def disable():
+    """
+    stop recording
+    :return: the recorder with the data collected so far
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def count(name: str, n: int = 1):
+    """
+    add n to the counter name, e.g. the transitions of a batched step
+    """
+    if _recorder is not None:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + int(n)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    time a block as the phase name
+    """
+    if _recorder is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        if _recorder is not None:
+            _recorder.record(name, start, time.perf_counter_ns())
+
+
+def timed(name: str):
+    """
+    decorator timing each call of the function as the phase name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if _recorder is not None:
+                    _recorder.record(name, start, time.perf_counter_ns())
+        return wrapper
+    return decorator
+
+
+def summary(recorder: Recorder = None):
+    """
+    :param recorder: a recorder returned by disable, the active one by default
+    :return: dict of the counters and of calls, total, mean and max seconds and
+    histogram {"<=N us": calls} of each phase
+    """
+    recorder = recorder or _recorder
+    if recorder is None:
+        return {"counters": {}, "phases": {}}
+
+    phases = {}
+    for name, (calls, total, longest, histogram) in sorted(recorder.timers.items(),
+                                                           key=lambda item: -item[1][1]):
+        phases[name] = {"calls": calls, "total_s": total / 1e9, "mean_us": total / calls / 1e3,
+                        "max_us": longest / 1e3,
+                        "histogram_us": {f"<{2 ** b}": n for b, n in enumerate(histogram) if n}}
+
+    return {"elapsed_s": (time.perf_counter_ns() - recorder.start) / 1e9,
+            "counters": dict(recorder.counters), "phases": phases}
+
+
+def export_json(path: str, recorder: Recorder = None):
+    with open(path, "w") as f:
+        json.dump(summary(recorder), f, indent=2)
+
+
+def export_chrome_trace(path: str, recorder: Recorder = None):
+    """
+    write the events in the Chrome trace event format, complete events in microseconds
+    """
+    recorder = recorder or _recorder
+    events = [] if recorder is None else recorder.events
+    pid = os.getpid()
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                                    "ts": (start - recorder.start) / 1e3, "dur": elapsed / 1e3}
+                                   for name, start, elapsed, tid in events],
+                   "displayTimeUnit": "ms"}, f)
+
+
+@contextlib.contextmanager
+def profile(path: str = None, memory: bool = True, top: int = 20):
+    """
+    run the block under cProfile and, with memory, tracemalloc. at the end the top
+    functions by cumulative time and the peak memory are printed; path saves the
+    cProfile stats (snakeviz, pstats) and path + ".mem.txt" the top allocation sites
+    :param path: file of the profile, not saved by default
+    :param memory: also trace the allocations, it slows down the python code
+    :param top: rows printed
+    """
+    # imported here, pstats alone costs every learner module some ms at load time
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    if memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+        print(stream.getvalue())
+        if path is not None:
+            profiler.dump_stats(path)
+
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"memory: current {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB")
+            if path is not None:
+                with open(path + ".mem.txt", "w") as f:
+                    for stat in snapshot.statistics("lineno")[:top]:
+                        f.write(f"{stat}\n")
@@ -1,3 +1,11 @@
+import time
+
+import numpy as np
+
+import Instrumentation
+from FiniteMDP import FiniteMDPenv
+
+
 class MonteCarlo:
     """
     estimating value function and discovering optimal policies.
@@ -166,47 +174,709 @@ class MonteCarlo:
     It also works for the on-policy case just by choosing the target and pehaviour policy
     as the same.
 
-    MANCA LA PARTE FINALE
+    Off-policy MC control, for estimating pi = pi* (pag. 133)
+    Initialize, for all s in S, a in A(s):
+        Q(s,a) in real (arbitrarily)
+        C(s,a) <- 0
+        pi(s) <- argmax(a) Q(s,a)
+    Loop forever (for each episode):
+        b <- any soft policy
+        Generate an episode using b: S0,A0,R1,...,S(T-1),A(T-1),RT
+        G <- 0
+        W <- 1
+        Loop for each step of episode, t=T-1,T-2,...,0:
+            G <- gamma G + R(t+1)
+            C(St,At) <- C(St,At) + W
+            Q(St,At) <- Q(St,At) + W/(C(St,At)) [G - Q(St,At)]
+            pi(St) <- argmax(a) Q(St,a)
+            If At != pi(St) then exit inner loop (proceed to next episode)
+            W <- W 1/b(At|St)
+
+    the target is greedy so it learns only from the tails of the episodes where b took the
+    greedy actions, if non greedy actions are common learning is slow.
+    the ratios are products of many terms, for long episodes keep them as sums of logs.
+    the effective sample size (sum W)^2 / sum W^2 shows how many of the returns really count.
 
     """
-    def __init__(self):
+    def __init__(self, env, gamma: float = 1., epsilon: float = 0.1, max_ep_length: int = 1000,
+                 num_envs: int = 64, seed=None):
+        """
+        all the tables are preallocated: Q, N are (S, A), V and his counts (S,), and the
+        episode is kept in fixed capacity buffers reused by every episode, so the memory does
+        not grow with the number of episodes
+        :param env: a FiniteMDPenv, or a VectorEnv for the batched methods only (the single
+        episode ones, as exploring starts, need to set the state of the model)
+        :param gamma: discount
+        :param epsilon: exploration of the eps-soft policies
+        :param max_ep_length: capacity of the episode buffers, longer episodes are truncated
+        :param num_envs: parallel episodes of the batched methods on a FiniteMDPenv
+        :param seed: seed or np.random.Generator
+        """
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.max_ep_length = max_ep_length
+        self.rng = np.random.default_rng(seed)
+
+        if isinstance(env, FiniteMDPenv):
+            self.mdp = env
+            self.env = env.vector_env(num_envs, self.rng)
+        else:
+            self.mdp = None
+            self.env = env
+
+        S, A = self.env.num_states, self.env.num_actions
+        valid = self.env.valid_actions
+
+        self.V = np.zeros(S)
+        self.V_count = np.zeros(S)
+        self.Q = np.zeros((S, A))
+        self.N = np.zeros((S, A))
+
+        # importance sampling sums of each pair: sum W = C(s,a), sum W^2, sum W G,
+        # sum (W G)^2 and the number of visits, for both estimators and the diagnostics
+        self.C = np.zeros((S, A))
+        self.W2 = np.zeros((S, A))
+        self.WG = np.zeros((S, A))
+        self.WG2 = np.zeros((S, A))
+        self.IS_visits = np.zeros((S, A))
+        self.policy = np.where(valid, self.rng.random((S, A)), -1).argmax(axis=1)
+
+        # uniform choice among A(s) by inverse cdf
+        self._valid_cdf = np.cumsum(valid / np.maximum(valid.sum(axis=1, keepdims=True), 1), axis=1)
+
+        # episode buffers: S_t, A_t, R_(t+1) and whether the visit at t is the first one
+        self.states = np.empty(max_ep_length, dtype=np.intp)
+        self.actions = np.empty(max_ep_length, dtype=np.intp)
+        self.rewards = np.empty(max_ep_length)
+        self.first_visit = np.empty(max_ep_length, dtype=bool)
+        self.length = 0
+
+        # episode number of the last visit of each state and each pair, the first visit check
+        # is then O(1) instead of scanning S0...S(t-1)
+        self._state_stamp = np.full(S, -1, dtype=np.int64)
+        self._pair_stamp = np.full(S * A, -1, dtype=np.int64)
+        self.episodes = 0
+
+    @Instrumentation.timed("mc.generate_episode")
+    def generate_episode(self, policy=None, epsilon: float = 0., start_state: int = None,
+                         start_action: int = None):
+        """
+        fill the buffers with S0,A0,R1,...,S(T-1),A(T-1),RT
+        :param policy: (S,) deterministic or (S, A) stochastic policy, self.policy by default
+        :param epsilon: probability of a random action in A(s) instead of the policy one
+        :param start_state: S0 for exploring starts, from the env reset otherwise
+        :param start_action: A0 for exploring starts
+        :return: the length T of the episode
+        """
+        mdp = self.mdp
+        if mdp is None:
+            raise ValueError("single episodes need a FiniteMDPenv, use the batched methods")
+        policy = self.policy if policy is None else np.asarray(policy)
+        stochastic = policy.ndim == 2
+        if stochastic:
+            policy = np.cumsum(policy, axis=1)
+
+        u = self.rng.random(self.max_ep_length)
+        explore = self.rng.random(self.max_ep_length) < epsilon
+
+        if start_state is None:
+            state, terminal = mdp.reset()
+        else:
+            mdp.state = state = start_state
+            terminal = bool(mdp.terminal[state])
+
+        t = 0
+        while not terminal and t < self.max_ep_length:
+            if t == 0 and start_action is not None:
+                action = start_action
+            elif explore[t]:
+                action = int(np.searchsorted(self._valid_cdf[state], u[t], side="right"))
+            elif stochastic:
+                action = int(np.searchsorted(policy[state], u[t], side="right"))
+            else:
+                action = policy[state]
+
+            self.states[t] = state
+            self.actions[t] = action
+            state, self.rewards[t], terminal = mdp.step(action)
+            t += 1
+
+        self.length = t
+
+        return t
+
+    def _mark_first_visits(self, by_state: bool):
+        """
+        flag in the first_visit buffer the first occurrence of each state (or pair) of the
+        current episode, stamping the tables with the episode number
+        """
+        self.episodes += 1
+        if by_state:
+            stamp, keys = self._state_stamp, self.states
+        else:
+            stamp, keys = self._pair_stamp, self.states * self.env.num_actions + self.actions
+
+        for t in range(self.length):
+            key = keys[t]
+            self.first_visit[t] = stamp[key] != self.episodes
+            stamp[key] = self.episodes
+
+    @Instrumentation.timed("mc.backup")
+    def _backup(self, first_visit: bool = True, by_state: bool = False, greedy: bool = False):
+        """
+        G <- gamma G + R(t+1) for t = T-1...0, and the incremental mean
+        Q(St,At) <- Q(St,At) + 1/N(St,At) [G - Q(St,At)] on the (first) visits
+        :param by_state: update V(St) instead of Q(St,At)
+        :param greedy: also pi(St) <- argmax(a) Q(St,a) after each update
         """
-        env variables to keep during the episode
+        if first_visit:
+            self._mark_first_visits(by_state)
+
+        valid = self.env.valid_actions
+        G = 0.
+        for t in range(self.length - 1, -1, -1):
+            G = self.gamma * G + self.rewards[t]
+            if first_visit and not self.first_visit[t]:
+                continue
+
+            s = self.states[t]
+            if by_state:
+                self.V_count[s] += 1
+                self.V[s] += (G - self.V[s]) / self.V_count[s]
+                continue
+
+            a = self.actions[t]
+            self.N[s, a] += 1
+            self.Q[s, a] += (G - self.Q[s, a]) / self.N[s, a]
+            if greedy:
+                self.policy[s] = np.where(valid[s], self.Q[s], -np.inf).argmax()
+
+    def prediction(self, policy, episodes: int, first_visit: bool = True):
         """
-        self.state = None
+        first visit (or every visit) MC prediction of v_pi
+        :param policy: (S,) deterministic or (S, A) stochastic policy to evaluate
+        :param episodes: number of episodes
+        :return: (S,) V
+        """
+        for _ in range(episodes):
+            self.generate_episode(policy)
+            self._backup(first_visit, by_state=True)
+
+        return self.V
 
-    def reset(self):
+    def q_prediction(self, policy, episodes: int, first_visit: bool = True):
         """
-        reset env variables
-        :return: the initial values for the state for the user and the agent and the bool
-        false for the "terminal" space.
+        same as prediction, for q_pi
+        :return: (S, A) Q
         """
-        self.state = None
+        for _ in range(episodes):
+            self.generate_episode(policy)
+            self._backup(first_visit)
 
-        return self.state, False
+        return self.Q
 
-    def step(self, action):
+    def exploring_starts(self, episodes: int):
         """
-        time step, from the current state, and action take reward, modify state
-        :param action: action taken by the agent
-        :return: return the new state and additional information for the user
+        Monte Carlo ES: every episode starts from a random pair with S0 non terminal and
+        A0 in A(S0), then follows the greedy policy
+        :return: Q and the greedy policy
         """
-        reward = 0 + action, self.state
+        live = np.flatnonzero(~self.mdp.terminal)
 
-        self.state = None, action
+        for _ in range(episodes):
+            state = live[self.rng.integers(len(live))]
+            action = int(np.searchsorted(self._valid_cdf[state], self.rng.random(), side="right"))
+            self.generate_episode(start_state=state, start_action=action)
+            self._backup(first_visit=True, greedy=True)
 
-        terminal = False
+        return self.Q, self.policy
 
-        return self.state, reward, terminal
+    def on_policy_control(self, episodes: int, epsilon: float = None, first_visit: bool = True):
+        """
+        on-policy MC control for eps-soft policies: the episodes follow the eps-greedy
+        policy of Q, pi(a|St) = 1 - eps + eps/|A(s)| for A* and eps/|A(s)| otherwise
+        :param epsilon: exploration, self.epsilon by default
+        :return: Q and the greedy policy
+        """
+        epsilon = self.epsilon if epsilon is None else epsilon
 
+        for _ in range(episodes):
+            self.generate_episode(epsilon=epsilon)
+            self._backup(first_visit, greedy=True)
 
-if __name__ == "__main__":
+        return self.Q, self.policy
 
-    max_ep_length = 100
+    @Instrumentation.timed("mc.generate_episodes")
+    def generate_episodes(self, num: int, policy=None, epsilon: float = 0.):
+        """
+        num episodes generated by the B environments of the vector env, one batched step
+        per time step: each sub environment fills a row with his episode and when it ends
+        (or reaches max_ep_length and is truncated) it starts the next row
+        :param num: number of episodes E
+        :param policy: (S,) deterministic or (S, A) stochastic policy, self.policy by default
+        :param epsilon: probability of a random action in A(s) instead of the policy one
+        :return: padded (E, max_ep_length) states, actions and rewards, and the (E,) lengths
+        """
+        env = self.env
+        policy = self.policy if policy is None else np.asarray(policy)
+        stochastic = policy.ndim == 2
+        if stochastic:
+            policy = np.cumsum(policy, axis=1)
+
+        T = self.max_ep_length
+        states = np.zeros((num, T), dtype=np.intp)
+        actions = np.zeros((num, T), dtype=np.intp)
+        rewards = np.zeros((num, T))
+        lengths = np.zeros(num, dtype=np.intp)
+
+        # row of the episode each sub environment is writing, -1 when there are no more
+        row = np.arange(env.num_envs)
+        row[row >= num] = -1
+        next_row = min(num, env.num_envs)
+
+        # once there are no more rows the exhausted sub environments are not stepped
+        env.reset()
+        active = np.flatnonzero(row >= 0)
+        while len(active):
+            s = env.obs[active]
+            u = self.rng.random((len(s), 1))
+            if stochastic:
+                a = (policy[s] <= u).sum(axis=1)
+            else:
+                a = policy[s]
+            if epsilon > 0:
+                explore = self.rng.random(len(s)) < epsilon
+                a = np.where(explore, (self._valid_cdf[s] <= u).sum(axis=1), a)
+
+            env.step(a, None if len(active) == env.num_envs else active)
+
+            r, t = row[active], lengths[row[active]]
+            states[r, t] = s
+            actions[r, t] = a
+            rewards[r, t] = env.rewards[active]
+            lengths[r] += 1
+
+            truncated = ~env.dones[active] & (lengths[r] == T)
+            env.reset_envs(active[truncated])
+            finished = active[env.dones[active] | truncated]
+            if len(finished):
+                new = min(len(finished), num - next_row)
+                row[finished] = -1
+                row[finished[:new]] = next_row + np.arange(new)
+                next_row += new
+                active = np.flatnonzero(row >= 0)
+
+        Instrumentation.count("mc.episodes", num)
+        Instrumentation.count("mc.steps", lengths.sum())
+
+        return states, actions, rewards, lengths
+
+    @Instrumentation.timed("mc.batch_update")
+    def batch_update(self, states, actions, rewards, lengths, first_visit: bool = True,
+                     by_state: bool = False, greedy: bool = False):
+        """
+        MC update of a whole batch of padded episodes with one chain of array operations:
+        all the returns together, the first visit mask from the first occurrence of each
+        (episode, pair) key, then the sums and counts of the returns of each pair with
+        bincount. the incremental mean of a batch, Q <- Q + (sum G - count Q) / N, is the
+        same as doing the single updates one after the other
+        :param states: (E, T_max) S_t
+        :param actions: (E, T_max) A_t
+        :param rewards: (E, T_max) R_(t+1), the padding must be 0
+        :param lengths: (E,) episode lengths T
+        :param first_visit: only the first visit of each pair (state) of each episode
+        :param by_state: update V instead of Q
+        :param greedy: pi(s) <- argmax(a) Q(s,a) for the updated states
+        """
+        S, A = self.env.num_states, self.env.num_actions
+        size = S if by_state else S * A
 
-    obs, terminal = MonteCarlo.reset()
+        valid = np.arange(states.shape[1]) < lengths[:, None]
+        G = discounted_returns(rewards, self.gamma)[valid]
+        keys = (states if by_state else states * A + actions)[valid]
 
-    while True:
+        if first_visit:
+            episode = np.repeat(np.arange(len(lengths)), lengths)
+            _, first = np.unique(episode * size + keys, return_index=True)
+            G, keys = G[first], keys[first]
+
+        sums = np.bincount(keys, G, size)
+        counts = np.bincount(keys, minlength=size)
+        values, visits = (self.V, self.V_count) if by_state else (self.Q.ravel(), self.N.ravel())
+
+        visits += counts
+        seen = counts > 0
+        values[seen] += (sums[seen] - counts[seen] * values[seen]) / visits[seen]
+
+        if greedy and not by_state:
+            updated = np.unique(keys // A)
+            self.policy[updated] = np.where(self.env.valid_actions[updated],
+                                            self.Q[updated], -np.inf).argmax(axis=1)
+
+    def batch_prediction(self, policy, episodes: int, batch_size: int = 1000,
+                         first_visit: bool = True):
+        """
+        prediction of v_pi with batches of episodes generated and updated together
+        :return: (S,) V
+        """
+        for start in range(0, episodes, batch_size):
+            batch = self.generate_episodes(min(batch_size, episodes - start), policy)
+            self.batch_update(*batch, first_visit=first_visit, by_state=True)
+
+        return self.V
+
+    def batch_control(self, episodes: int, batch_size: int = 1000, epsilon: float = None,
+                      first_visit: bool = True):
+        """
+        on-policy eps-soft control, the policy is improved after each batch of episodes
+        :return: Q and the greedy policy
+        """
+        epsilon = self.epsilon if epsilon is None else epsilon
+
+        for start in range(0, episodes, batch_size):
+            batch = self.generate_episodes(min(batch_size, episodes - start), epsilon=epsilon)
+            self.batch_update(*batch, first_visit=first_visit, greedy=True)
+
+        return self.Q, self.policy
+
+    @Instrumentation.timed("mc.off_policy_update")
+    def off_policy_update(self, states, actions, rewards, lengths, target, behaviour):
+        """
+        every visit off-policy update of a batch of padded episodes generated by behaviour.
+        the weight of step t is W_t = prod(k=t+1...T-1) pi(Ak|Sk)/b(Ak|Sk), computed as a
+        reverse cumulative sum of log ratios so long episodes do not underflow. the steps
+        before the last zero ratio have W = 0, the point where the backward loop stops, and
+        are dropped before the sums. they still count as visits for ordinary sampling
+        :param states: (E, T_max) S_t
+        :param actions: (E, T_max) A_t
+        :param rewards: (E, T_max) R_(t+1), the padding must be 0
+        :param lengths: (E,) episode lengths
+        :param target: (S, A) probabilities of pi, or (S,) deterministic actions
+        :param behaviour: (S, A) probabilities of b, with coverage of pi
+        """
+        A = self.env.num_actions
+        valid = np.arange(states.shape[1]) < lengths[:, None]
+        target = np.asarray(target)
+        if target.ndim == 1:
+            target = np.eye(A)[target]
+
+        with np.errstate(divide="ignore"):
+            log_ratio = np.log(target[states, actions]) - np.log(behaviour[states, actions])
+        log_ratio[~valid] = 0
+
+        # log W_t is the sum of the log ratios after t
+        log_W = np.zeros(log_ratio.shape)
+        log_W[:, :-1] = np.cumsum(log_ratio[:, :0:-1], axis=1)[:, ::-1]
+        W = np.exp(log_W)
+
+        keys = (states * A + actions)[valid]
+        size = self.Q.size
+        self.IS_visits += np.bincount(keys, minlength=size).reshape(self.Q.shape)
+
+        alive = W[valid] > 0
+        keys, W = keys[alive], W[valid][alive]
+        WG = W * discounted_returns(rewards, self.gamma)[valid][alive]
+
+        self.C += np.bincount(keys, W, size).reshape(self.Q.shape)
+        self.W2 += np.bincount(keys, W * W, size).reshape(self.Q.shape)
+        self.WG += np.bincount(keys, WG, size).reshape(self.Q.shape)
+        self.WG2 += np.bincount(keys, WG * WG, size).reshape(self.Q.shape)
+
+        # the weighted estimate sum W G / C is what the incremental update converges to
+        np.divide(self.WG, self.C, out=self.Q, where=self.C > 0)
+
+    def off_policy_prediction(self, target, behaviour, episodes: int, batch_size: int = 1000):
+        """
+        off-policy prediction of q_pi from episodes of b, in batches
+        :param target: (S, A) probabilities of pi, or (S,) deterministic actions
+        :param behaviour: (S, A) probabilities of b
+        :return: the weighted and the ordinary importance sampling estimates of Q
+        """
+        for start in range(0, episodes, batch_size):
+            batch = self.generate_episodes(min(batch_size, episodes - start), behaviour)
+            self.off_policy_update(*batch, target, behaviour)
+
+        return self.Q, self.ordinary_estimate()
+
+    def off_policy_evaluation(self, store, target, behaviour, batch_size: int = 1000):
+        """
+        offline off-policy prediction of q_pi from the episodes of b saved in a
+        TrajectoryStore, read one padded batch at a time from the memory mapped log
+        :param store: Trajectories.TrajectoryStore written while following behaviour
+        :param target: (S, A) probabilities of pi, or (S,) deterministic actions
+        :param behaviour: (S, A) probabilities of b, the policy that generated the log
+        :return: the weighted and the ordinary importance sampling estimates of Q
+        """
+        for batch in store.batches(batch_size):
+            self.off_policy_update(*batch, target, behaviour)
+
+        return self.Q, self.ordinary_estimate()
+
+    def ordinary_estimate(self):
+        """
+        :return: (S, A) ordinary importance sampling estimate, sum W G / number of visits
+        """
+        return np.divide(self.WG, self.IS_visits, out=np.zeros_like(self.WG),
+                         where=self.IS_visits > 0)
+
+    def importance_sampling_diagnostics(self):
+        """
+        per pair diagnostics of the importance sampling
+        :return: dict with the visits, the effective sample size (sum W)^2 / sum W^2, its
+        fraction of the visits (near 0 when the behaviour wastes his samples) and the
+        variance of the ordinary sampling terms W G
+        """
+        seen = self.IS_visits > 0
+        ess = np.divide(self.C ** 2, self.W2, out=np.zeros_like(self.C), where=self.W2 > 0)
+        mean = self.ordinary_estimate()
+        variance = np.divide(self.WG2, self.IS_visits, out=np.zeros_like(self.C), where=seen)
+        variance -= mean ** 2
+
+        return {"visits": self.IS_visits.copy(), "ess": ess,
+                "ess_fraction": np.divide(ess, self.IS_visits, out=np.zeros_like(ess), where=seen),
+                "variance": variance}
+
+    def off_policy_control(self, episodes: int, behaviour=None):
+        """
+        off-policy MC control with a greedy target, episode by episode: the backward loop
+        exits at the first action that is not the greedy one, since W becomes 0. W is kept
+        as log W
+        :param behaviour: (S, A) soft policy b, the equiprobable one over A(s) by default
+        :return: the weighted estimate Q and the greedy policy
+        """
+        valid = self.env.valid_actions
+        if behaviour is None:
+            behaviour = valid / np.maximum(valid.sum(axis=1, keepdims=True), 1)
+        log_b = np.log(behaviour, out=np.full(behaviour.shape, -np.inf), where=behaviour > 0)
+
+        for _ in range(episodes):
+            self.generate_episode(behaviour)
+            # as in off_policy_update the steps before the exit have W = 0 but are visits
+            np.add.at(self.IS_visits, (self.states[:self.length], self.actions[:self.length]), 1)
+
+            G = 0.
+            log_W = 0.
+            for t in range(self.length - 1, -1, -1):
+                G = self.gamma * G + self.rewards[t]
+                s, a = self.states[t], self.actions[t]
+                W = np.exp(log_W)
+
+                self.C[s, a] += W
+                self.W2[s, a] += W * W
+                self.WG[s, a] += W * G
+                self.WG2[s, a] += (W * G) ** 2
+                self.Q[s, a] += W / self.C[s, a] * (G - self.Q[s, a])
+                self.policy[s] = np.where(valid[s], self.Q[s], -np.inf).argmax()
+
+                if a != self.policy[s]:
+                    break
+                log_W -= log_b[s, a]
+
+        return self.Q, self.policy
+
+    def parallel_control(self, episodes: int, workers: int = 4, batch_size: int = 1000,
+                         slots: int = None, epsilon: float = None, first_visit: bool = True):
+        """
+        on-policy eps-soft control where the episodes are generated by worker processes.
+        every worker writes his episodes into his own ring buffer of slots padded episodes in
+        shared memory (single producer, single consumer: the worker moves the head, this
+        process the tail), this process takes them in batches, updates Q and writes the
+        greedy policy into a shared array that the workers read before each chunk of
+        episodes. no trajectory or table is ever pickled.
+        every worker steps num_envs environments like the serial batch_control and writes
+        chunks of up to batch_size episodes, so the batches are as large as the serial ones
+        :param episodes: total number of episodes to learn from
+        :param workers: number of generating processes
+        :param batch_size: episodes of each learner update and of each worker chunk
+        :param slots: capacity of each ring buffer, in episodes, 2 * batch_size by default
+        :param epsilon: exploration, self.epsilon by default
+        :return: Q and the greedy policy
+        """
+        if self.mdp is None:
+            raise ValueError("the workers need a FiniteMDPenv to sample")
+        epsilon = self.epsilon if epsilon is None else epsilon
+        slots = 2 * batch_size if slots is None else slots
+        chunk = min(batch_size, slots)
+        T = self.max_ep_length
+        blocks, processes = [], []
+        control = None
+
+        def shared(shape, dtype):
+            shm, array = _shared_array(shape, dtype)
+            blocks.append(shm)
+            return array, (shm.name, shape, np.dtype(dtype).str)
+
+        try:
+            policy, policy_layout = shared(self.policy.shape, np.intp)
+            control, control_layout = shared((1,), np.int64)
+            policy[:] = self.policy
+            control[0] = 0
+
+            rings, layouts = [], []
+            for _ in range(workers):
+                ring, layout = {}, {"policy": policy_layout, "control": control_layout}
+                for name, shape, dtype in (("states", (slots, T), np.intp),
+                                           ("actions", (slots, T), np.intp),
+                                           ("rewards", (slots, T), float),
+                                           ("lengths", (slots,), np.intp),
+                                           ("counters", (2,), np.int64)):
+                    ring[name], layout[name] = shared(shape, dtype)
+                ring["counters"][:] = 0
+                rings.append(ring)
+                layouts.append(layout)
+
+            seeds = np.random.SeedSequence(self.rng.integers(2 ** 63)).spawn(workers)
+            import multiprocessing
+            context = multiprocessing.get_context()
+            for i in range(workers):
+                processes.append(context.Process(target=_episode_worker, daemon=True,
+                                                 args=(self.mdp, layouts[i], seeds[i], epsilon, T,
+                                                       self.env.num_envs, chunk)))
+                processes[-1].start()
+
+            consumed = 0
+            while consumed < episodes:
+                batch = []
+                for ring in rings:
+                    head, tail = ring["counters"]
+                    take = min(head - tail, episodes - consumed - sum(len(b[3]) for b in batch))
+                    if take <= 0:
+                        continue
+                    index = (tail + np.arange(take)) % slots
+                    batch.append(tuple(ring[name][index] for name in
+                                       ("states", "actions", "rewards", "lengths")))
+                    ring["counters"][1] = tail + take
+
+                if not batch:
+                    # workers that die before writing anything would leave this loop waiting
+                    if any(not process.is_alive() for process in processes):
+                        raise RuntimeError("an episode worker died")
+                    time.sleep(1e-4)
+                    continue
+
+                for part in batch:
+                    self.batch_update(*part, first_visit=first_visit, greedy=True)
+                    consumed += len(part[3])
+                policy[:] = self.policy
+
+                if any(not process.is_alive() for process in processes):
+                    raise RuntimeError("an episode worker died")
+        finally:
+            if control is not None:
+                control[0] = 1
+            for process in processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            # the arrays are views of the blocks, drop them before closing
+            policy = control = rings = ring = None
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        return self.Q, self.policy
+
+
+def _shared_array(shape, dtype, name: str = None):
+    """
+    create (name None) or attach a shared memory block viewed as an array
+    :return: the SharedMemory, to close, and the array
+    """
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _episode_worker(mdp: FiniteMDPenv, layout: dict, seed, epsilon: float, max_ep_length: int,
+                    num_envs: int, chunk: int):
+    """
+    body of the parallel_control workers: generate eps-greedy episodes of the shared policy
+    into the ring buffer while there are free slots, until the control flag is raised
+    :param num_envs: environments stepped together by the worker
+    :param chunk: episodes generated at most between two reads of the policy
+    """
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in layout.items():
+        shm, arrays[name] = _shared_array(shape, dtype, shm_name)
+        blocks.append(shm)
+
+    mc = MonteCarlo(mdp, epsilon=epsilon, max_ep_length=max_ep_length, num_envs=num_envs, seed=seed)
+    counters = arrays["counters"]
+    slots = len(arrays["lengths"])
+
+    try:
+        while arrays["control"][0] == 0:
+            head, tail = counters
+            free = slots - (head - tail)
+            if free == 0:
+                time.sleep(1e-4)
+                continue
+
+            mc.policy[:] = arrays["policy"]
+            states, actions, rewards, lengths = mc.generate_episodes(min(free, chunk), epsilon=epsilon)
+
+            index = (head + np.arange(len(lengths))) % slots
+            arrays["states"][index] = states
+            arrays["actions"][index] = actions
+            arrays["rewards"][index] = rewards
+            arrays["lengths"][index] = lengths
+            # the slots are complete before the learner can see them
+            counters[0] = head + len(lengths)
+    finally:
+        del arrays, counters
+        for shm in blocks:
+            shm.close()
+
+
+def discounted_returns(rewards, gamma: float):
+    """
+    G_t = R_(t+1) + gamma G_(t+1) for every row at once, as a reverse discounted cumulative
+    sum: the filter y[n] = x[n] + gamma y[n-1] on the time reversed rewards, and just a
+    reverse cumsum without discount (scipy is only imported for gamma < 1).
+    zero padding after the end of an episode does not change his returns
+    :param rewards: (E, T) rewards
+    :param gamma: discount
+    :return: (E, T) returns
+    """
+    reverse = np.ascontiguousarray(rewards[:, ::-1], dtype=float)
+    if gamma == 1:
+        return np.cumsum(reverse, axis=1)[:, ::-1]
+
+    from scipy.signal import lfilter
+    return lfilter([1.], [1., -gamma], reverse, axis=1)[:, ::-1]
+
+
+if __name__ == "__main__":
+
+    max_ep_length = 100
 
-        if terminal:
-            break
\ No newline at end of file
+    # random walk of example 6.2: states 0 and 6 terminal, reward 1 on the right end,
+    # v_pi of the equiprobable policy is 1/6, 2/6, ..., 5/6
+    S, A = 7, 2
+    s = np.repeat(np.arange(1, 6), 2)
+    a = np.tile([0, 1], 5)
+    s_next = s + 2 * a - 1
+    walk = FiniteMDPenv.from_transitions(S, A, s, a, s_next, np.ones(10), s_next == 6,
+                                         terminal=np.isin(np.arange(S), [0, 6]),
+                                         initial=np.eye(S)[3], seed=0)
+
+    mc = MonteCarlo(walk, max_ep_length=max_ep_length, seed=0)
+    print("first visit V:", mc.prediction(np.full((S, A), 0.5), 5000).round(2))
+
+    mc = MonteCarlo(walk, max_ep_length=max_ep_length, seed=0)
+    Q, pi = mc.exploring_starts(2000)
+    print("exploring starts, greedy policy:", pi[1:6])
+
+    mc = MonteCarlo(walk, max_ep_length=max_ep_length, seed=0)
+    print("batched every visit V:", mc.batch_prediction(np.full((S, A), 0.5), 10000,
+                                                         first_visit=False).round(2))
+
+    mc = MonteCarlo(walk, max_ep_length=max_ep_length, seed=0)
+    always_right = np.ones(S, dtype=int)
+    weighted, ordinary = mc.off_policy_prediction(always_right, np.full((S, A), 0.5), 10000)
+    print("off-policy q of always right, weighted:", weighted[1:6, 1].round(2),
+          "ordinary:", ordinary[1:6, 1].round(2))
+    print("effective sample size fraction:",
+          mc.importance_sampling_diagnostics()["ess_fraction"][1:6, 1].round(3))
@@ -1,50 +1,609 @@
-class TDlearning:
+import time
+
+import numpy as np
+
+import Instrumentation
+from FiniteMDP import FiniteMDPenv
+from kArmedBandit import random_argmax
+
+
+class LockstepTD:
+    """
+    the loop shared by the TD learners: B copies of the environment are stepped in lockstep
+    and every update works on the whole batch of transitions. the subclasses give the values,
+    with choose_action(states) and _update(states, actions, rewards, next_states, done,
+    method, next_actions, weights), and Q, returned by the control methods
+    """
+    def __init__(self, env, num_envs: int = 1, alpha: float = 0.1, gamma: float = 1.,
+                 epsilon: float = 0.1, seed=None):
+        """
+        :param env: a VectorEnv, or a FiniteMDPenv run as num_envs parallel episodes
+        :param num_envs: number of parallel environments B of a FiniteMDPenv
+        :param alpha: step size
+        :param gamma: discount
+        :param epsilon: exploration of the eps-greedy policies
+        :param seed: seed or np.random.Generator
+        """
+        self.rng = np.random.default_rng(seed)
+        if isinstance(env, FiniteMDPenv):
+            env = env.vector_env(num_envs, self.rng)
+
+        self.env = env
+        self.num_envs = env.num_envs
+        self.alpha = alpha
+        self.gamma = gamma
+        self.epsilon = epsilon
+
+        self.transitions = 0
+
+        # learned model of Dyna-Q, built by the first planning run
+        self.model = None
+
+    @property
+    def episode_returns(self):
+        """ undiscounted returns of the last finished episodes, see VectorEnv """
+        return self.env.episode_returns
+
+    @Instrumentation.timed("td.step")
+    def _step(self, actions):
+        """
+        one transition of every environment, the finished ones are reset by the env
+        :return: the states where the actions were taken, the next states (the last ones
+        for the finished episodes), rewards and done flags
+        """
+        states = self.env.obs.copy()
+        self.env.step(actions)
+        self.transitions += self.num_envs
+        Instrumentation.count("td.transitions", self.num_envs)
+
+        return states, self.env.final_obs, self.env.rewards, self.env.dones
+
+    def _policy_actions(self, policy, states):
+        if policy.ndim == 1:
+            return policy[states]
+        u = self.rng.random((len(states), 1))
+        return (policy[states] <= u).sum(axis=1)
+
+    def _dyna_model(self):
+        """
+        :return: the model the planning steps learn and sample from
+        """
+        return DynaModel(self.env.num_states, self.env.num_actions, self.rng)
+
+    def _control(self, steps: int, method: str, replay=None, batch_size: int = 32,
+                 planning_steps: int = 0):
+        if method == "sarsa" and (replay is not None or planning_steps):
+            raise ValueError("replay and planning need an off-policy target, not sarsa")
+        if planning_steps and self.model is None:
+            self.model = self._dyna_model()
+
+        self.env.reset()
+        actions = self.choose_action(self.env.obs)
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(actions)
+            # the actions of the next step, from the reset states where an episode ended
+            next_actions = self.choose_action(self.env.obs)
+
+            self._update(states, actions, rewards, next_states, done, method, next_actions)
+
+            if replay is not None:
+                replay.add(states, actions, rewards, next_states, done)
+                index, batch, weights = replay.sample(batch_size)
+                delta = self._update(*batch, method, weights=weights)
+                replay.update_priorities(index, delta)
+
+            if planning_steps:
+                self.model.update(states, actions, rewards, next_states, done)
+                simulated = self.model.sample(planning_steps * self.num_envs)
+                self._update(*simulated, method)
+
+            actions = next_actions
+
+        return self.Q
+
+    def sarsa(self, steps: int):
+        """
+        on-policy TD control
+        Q(S,A) <- Q(S,A) + alpha [R + gamma Q(S',A') - Q(S,A)], A' eps-greedy from S'
+        :param steps: lockstep steps, steps * B transitions
+        :return: (S, A) Q
+        """
+        return self._control(steps, "sarsa")
+
+    def q_learning(self, steps: int, replay=None, batch_size: int = 32, planning_steps: int = 0):
+        """
+        off-policy TD control
+        Q(S,A) <- Q(S,A) + alpha [R + gamma max(a) Q(S',a) - Q(S,A)]
+        every real transition can be reused: with a replay buffer each step also learns from
+        batch_size stored transitions, and with planning_steps = k it is Dyna-Q, k simulated
+        updates for each real transition from the learned tabular model (pag. 164)
+        :param replay: ReplayBuffer the transitions are stored in and sampled from
+        :param batch_size: replayed transitions for each lockstep step
+        :param planning_steps: simulated updates for each real transition
+        :return: (S, A) Q
+        """
+        return self._control(steps, "q_learning", replay, batch_size, planning_steps)
+
+    def expected_sarsa(self, steps: int, replay=None, batch_size: int = 32,
+                       planning_steps: int = 0):
+        """
+        Q(S,A) <- Q(S,A) + alpha [R + gamma sum(a) pi(a|S') Q(S',a) - Q(S,A)]
+        with pi the eps-greedy policy of Q, replay and planning as in q_learning
+        :return: (S, A) Q
+        """
+        return self._control(steps, "expected_sarsa", replay, batch_size, planning_steps)
+
+
+class TDlearning(LockstepTD):
     """
     It is basically a combination of MC and DP ideas.
     TD methods update estimates based in part on other learned estimates, without waiting for a
     final outcome (bootstrap).
     First policy evaluation and then GPI as before.
 
+    eligibility traces bridge TD and MC: every visited pair keeps a trace e(s,a) that decays
+    by gamma lambda each step, and each TD error updates all the pairs in proportion to it.
+    lambda = 0 is one step TD, lambda = 1 behaves like MC on the whole episode.
+
 
     """
-    def __init__(self):
+    def __init__(self, env, num_envs: int = 1, alpha: float = 0.1, gamma: float = 1.,
+                 epsilon: float = 0.1, seed=None):
         """
-        env variables to keep during the episode
+        tabular V and Q, every update is one fancy indexed operation over the whole batch;
+        when the same pair appears more than once in a batch it gets the mean of its
+        increments, so alpha keeps its meaning for any B. the params are those of LockstepTD
         """
-        self.state = None
+        super().__init__(env, num_envs, alpha, gamma, epsilon, seed)
+        env = self.env
+
+        S, A = env.num_states, env.num_actions
+        self.V = np.zeros(S)
+        self.Q = np.zeros((S, A))
+        self._Q_flat = self.Q.reshape(-1)
 
-    def reset(self):
+        self._invalid = ~env.valid_actions
+        valid = env.valid_actions
+        self._valid_count = np.maximum(valid.sum(axis=1), 1)
+        self._valid_cdf = np.cumsum(valid / self._valid_count[:, None], axis=1)
+
+    @Instrumentation.timed("td.choose_action")
+    def choose_action(self, states, epsilon: float = None):
         """
-        reset env variables
-        :return: the initial values for the state for the user and the agent and the bool
-        false for the "terminal" space.
+        eps-greedy actions of Q for a batch of states, ties broken at random
+        :return: (n,) actions in A(s)
         """
-        self.state = None
+        epsilon = self.epsilon if epsilon is None else epsilon
+        values = self.Q[states]
+        values[self._invalid[states]] = -np.inf
+        actions = random_argmax(values, self.rng)
+
+        if epsilon > 0:
+            explore = self.rng.random(len(states)) < epsilon
+            if np.any(explore):
+                u = self.rng.random((np.count_nonzero(explore), 1))
+                actions[explore] = (self._valid_cdf[states[explore]] <= u).sum(axis=1)
 
-        return self.state, False
+        return actions
 
-    def step(self, action):
+    def td0_prediction(self, policy, steps: int):
         """
-        time step, from the current state, and action take reward, modify state
-        :param action: action taken by the agent
-        :return: return the new state and additional information for the user
+        TD(0) for v_pi: V(S) <- V(S) + alpha [R + gamma V(S') - V(S)]
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param steps: lockstep steps, steps * B transitions
+        :return: (S,) V
         """
-        reward = 0 + action, self.state
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.cumsum(policy, axis=1)
+        self.env.reset()
 
-        self.state = None, action
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(
+                self._policy_actions(policy, self.env.obs))
+            delta = rewards + self.gamma * self.V[next_states] * ~done - self.V[states]
+            scatter_mean_add(self.V, states, self.alpha * delta)
+
+        return self.V
+
+    def _next_values(self, next_states, method: str):
+        """
+        bootstrap value of the next states for Q-learning and Expected SARSA
+        """
+        values = self.Q[next_states]
+        values[self._invalid[next_states]] = -np.inf
+        best = values.max(axis=1)
+        if method == "q_learning":
+            return best
+
+        # expected value under the eps-greedy policy of Q
+        values[self._invalid[next_states]] = 0
+        mean = values.sum(axis=1) / self._valid_count[next_states]
+        return (1 - self.epsilon) * best + self.epsilon * mean
+
+    @Instrumentation.timed("td.update")
+    def _update(self, states, actions, rewards, next_states, done, method: str,
+                next_actions=None, weights=None):
+        """
+        one TD update of a batch of transitions
+        :param weights: importance weights of prioritized replay, multiplied to the steps
+        :return: the TD errors
+        """
+        if method == "sarsa":
+            next_values = self.Q[next_states, next_actions]
+        else:
+            next_values = self._next_values(next_states, method)
 
-        terminal = False
+        keys = states * self.env.num_actions + actions
+        delta = rewards + self.gamma * np.where(done, 0., next_values) - self._Q_flat[keys]
+        step = self.alpha * delta if weights is None else self.alpha * weights * delta
+        scatter_mean_add(self._Q_flat, keys, step)
 
-        return self.state, reward, terminal
+        return delta
+
+    def td_lambda(self, policy, steps: int, lam: float = 0.9, trace: str = "accumulating",
+                  threshold: float = 1e-3):
+        """
+        TD(lambda) prediction of v_pi with eligibility traces
+        delta = R + gamma V(S') - V(S), e(S) bumped by the trace rule, V <- V + alpha delta e,
+        then e <- gamma lambda e. only the active traces are stored and touched, see
+        SparseTraces
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param steps: lockstep steps, steps * B transitions
+        :param lam: trace decay lambda, 0 is TD(0) and 1 is close to every visit MC
+        :param trace: "accumulating", "replacing" or "dutch"
+        :param threshold: traces below it are dropped
+        :return: (S,) V
+        """
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.cumsum(policy, axis=1)
+        traces = SparseTraces(self.env.num_states, trace, threshold)
+        envs = np.arange(self.num_envs)
+        self.env.reset()
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(
+                self._policy_actions(policy, self.env.obs))
+            delta = rewards + self.gamma * self.V[next_states] * ~done - self.V[states]
+
+            traces.visit(envs, states, self.alpha)
+            scatter_mean_add(self.V, traces.index, self.alpha * delta[traces.envs] * traces.values)
+            traces.decay(self.gamma * lam, done)
+
+        return self.V
+
+    def sarsa_lambda(self, steps: int, lam: float = 0.9, trace: str = "replacing",
+                     threshold: float = 1e-3):
+        """
+        SARSA(lambda): the TD error of every step updates all the pairs of the episode with
+        their trace, so the per step cost grows with the effective trace length, about
+        log(threshold) / log(gamma lambda) pairs for each environment, and not with |S||A|
+        :param steps: lockstep steps, steps * B transitions
+        :param lam: trace decay lambda
+        :param trace: "accumulating", "replacing" or "dutch"
+        :param threshold: traces below it are dropped
+        :return: (S, A) Q
+        """
+        A = self.env.num_actions
+        traces = SparseTraces(self.Q.size, trace, threshold)
+        envs = np.arange(self.num_envs)
+        self.env.reset()
+        actions = self.choose_action(self.env.obs)
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(actions)
+            next_actions = self.choose_action(self.env.obs)
+
+            keys = states * A + actions
+            delta = (rewards + self.gamma * self.Q[next_states, next_actions] * ~done -
+                     self._Q_flat[keys])
+
+            traces.visit(envs, keys, self.alpha)
+            scatter_mean_add(self._Q_flat, traces.index,
+                             self.alpha * delta[traces.envs] * traces.values)
+            traces.decay(self.gamma * lam, done)
+
+            actions = next_actions
+
+        return self.Q
+
+    def greedy_policy(self):
+        """
+        :return: (S,) greedy actions of Q over A(s)
+        """
+        return np.where(self._invalid, -np.inf, self.Q).argmax(axis=1)
+
+
+class SparseTraces:
+    """
+    eligibility traces of B parallel environments kept only for the entries that are not
+    negligible: parallel arrays of keys env * size + index and of trace values, instead of
+    a dense (B, size) array decayed at every step. a visit merges the visited keys into the
+    active ones, the decay drops the traces under the threshold and those of the finished
+    episodes. the rules on the visited entry:
+    accumulating e <- e + 1, replacing e <- 1, dutch e <- (1 - alpha) e + 1
+    """
+    def __init__(self, size: int, kind: str = "accumulating", threshold: float = 1e-3):
+        if kind not in ("accumulating", "replacing", "dutch"):
+            raise ValueError(f"unknown trace {kind}")
+        self.size = size
+        self.kind = kind
+        self.threshold = threshold
+
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0)
+
+    @property
+    def envs(self):
+        """ environment of each active trace """
+        return self.keys // self.size
+
+    @property
+    def index(self):
+        """ table entry of each active trace """
+        return self.keys % self.size
+
+    def visit(self, envs, index, alpha: float = 0.):
+        """
+        :param envs: (n,) environments, each one at most once
+        :param index: (n,) entry visited by each of them
+        :param alpha: step size, used by the dutch trace
+        """
+        visited = envs.astype(np.int64) * self.size + index
+        keys, inverse = np.unique(np.concatenate([self.keys, visited]), return_inverse=True)
+        values = np.zeros(len(keys))
+        values[inverse[:len(self.keys)]] = self.values
+        current = inverse[len(self.keys):]
+
+        if self.kind == "accumulating":
+            values[current] += 1
+        elif self.kind == "replacing":
+            values[current] = 1
+        else:
+            values[current] = (1 - alpha) * values[current] + 1
+
+        self.keys, self.values = keys, values
+
+    def decay(self, factor: float, done=None):
+        """
+        e <- factor e, dropping the small traces and, where done, all the traces of the env
+        """
+        self.values *= factor
+        keep = self.values >= self.threshold
+        if done is not None and np.any(done):
+            keep &= ~done[self.envs]
+        self.keys, self.values = self.keys[keep], self.values[keep]
+
+
+class SumTree:
+    """
+    binary tree where every node is the sum of his children, the leaves are the priorities.
+    batches of updates and samples walk the log2(capacity) levels with one array operation
+    per level, so their cost does not grow with the capacity
+    """
+    def __init__(self, capacity: int):
+        self.leaves = 1 << max(int(capacity - 1).bit_length(), 0)
+        self.tree = np.zeros(2 * self.leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, index, priorities):
+        """
+        :param index: (n,) leaf positions
+        :param priorities: (n,) new priorities
+        """
+        node = np.asarray(index) + self.leaves
+        self.tree[node] = priorities
+        node = np.unique(node // 2)
+        while node[0] >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node = np.unique(node // 2)
+
+    def find(self, values):
+        """
+        :param values: (n,) numbers in [0, total)
+        :return: (n,) leaf positions whose cumulative priority interval contains each value
+        """
+        values = np.array(values, dtype=float)
+        node = np.ones(len(values), dtype=np.intp)
+        while node[0] < self.leaves:
+            left = self.tree[2 * node]
+            right = values >= left
+            values -= left * right
+            node = 2 * node + right
+
+        return node - self.leaves
+
+
+class ReplayBuffer:
+    """
+    fixed capacity circular buffer of transitions as a struct of arrays, the oldest ones are
+    overwritten. sampling is uniform, or proportional to |delta|^priority_exponent with a
+    SumTree (prioritized replay) where new transitions get the largest priority seen and the
+    importance weights (N P(i))^-beta / max correct the bias
+    """
+    def __init__(self, capacity: int, prioritized: bool = False, priority_exponent: float = 0.6,
+                 beta: float = 0.4, seed=None):
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.beta = beta
+        self.rng = np.random.default_rng(seed)
+
+        self.states = np.zeros(capacity, dtype=np.intp)
+        self.actions = np.zeros(capacity, dtype=np.intp)
+        self.rewards = np.zeros(capacity)
+        self.next_states = np.zeros(capacity, dtype=np.intp)
+        self.dones = np.zeros(capacity, dtype=bool)
+
+        self.size = 0
+        self._cursor = 0
+        self.tree = SumTree(capacity) if prioritized else None
+        self._max_priority = 1.
+
+    def add(self, states, actions, rewards, next_states, dones):
+        """
+        store a batch of transitions
+        """
+        index = (self._cursor + np.arange(len(states))) % self.capacity
+        self.states[index] = states
+        self.actions[index] = actions
+        self.rewards[index] = rewards
+        self.next_states[index] = next_states
+        self.dones[index] = dones
+
+        self._cursor = (self._cursor + len(states)) % self.capacity
+        self.size = min(self.size + len(states), self.capacity)
+        if self.prioritized:
+            self.tree.update(index, np.full(len(index), self._max_priority))
+
+    def sample(self, n: int):
+        """
+        :param n: number of transitions
+        :return: their positions, the (states, actions, rewards, next_states, dones) arrays and
+        the importance weights (None for uniform sampling)
+        """
+        if not self.prioritized:
+            index = self.rng.integers(self.size, size=n)
+            weights = None
+        else:
+            # one value in each of n equal segments of the total priority
+            total = self.tree.total()
+            index = self.tree.find((np.arange(n) + self.rng.random(n)) * total / n)
+            np.minimum(index, self.size - 1, out=index)
+            probs = self.tree.tree[index + self.tree.leaves] / total
+            weights = (self.size * probs) ** -self.beta
+            weights /= weights.max()
+
+        batch = (self.states[index], self.actions[index], self.rewards[index],
+                 self.next_states[index], self.dones[index])
+
+        return index, batch, weights
+
+    def update_priorities(self, index, td_errors):
+        """
+        new priorities of sampled transitions, nothing for uniform sampling
+        """
+        if not self.prioritized:
+            return
+        priorities = (np.abs(td_errors) + 1e-6) ** self.priority_exponent
+        self._max_priority = max(self._max_priority, float(priorities.max()))
+        self.tree.update(index, priorities)
+
+
+class DynaModel:
+    """
+    tabular model of Dyna-Q: for each pair the last observed next state, reward and end of
+    episode (exact for deterministic environments). the observed pairs are also kept in an
+    array, so the previously observed pairs of the planning are sampled in O(1)
+    """
+    def __init__(self, num_states: int, num_actions: int, rng=None):
+        self.num_actions = num_actions
+        self.rng = np.random.default_rng(rng)
+
+        size = num_states * num_actions
+        self.next_states = np.zeros(size, dtype=np.intp)
+        self.rewards = np.zeros(size)
+        self.dones = np.zeros(size, dtype=bool)
+        self.seen = np.zeros(size, dtype=bool)
+        self.observed = np.zeros(size, dtype=np.intp)
+        self.num_observed = 0
+
+    def update(self, states, actions, rewards, next_states, dones):
+        """
+        Model(S,A) <- R, S' for a batch of real transitions
+        """
+        keys = states * self.num_actions + actions
+        self.next_states[keys] = next_states
+        self.rewards[keys] = rewards
+        self.dones[keys] = dones
+
+        new = np.unique(keys[~self.seen[keys]])
+        self.seen[new] = True
+        self.observed[self.num_observed:self.num_observed + len(new)] = new
+        self.num_observed += len(new)
+
+    def sample(self, n: int):
+        """
+        :return: n simulated transitions (states, actions, rewards, next_states, dones) of
+        random previously observed pairs
+        """
+        keys = self.observed[self.rng.integers(self.num_observed, size=n)]
+        states, actions = np.divmod(keys, self.num_actions)
+
+        return states, actions, self.rewards[keys], self.next_states[keys], self.dones[keys]
+
+
+def scatter_mean_add(table, index, increments):
+    """
+    table[index] += increments, where a repeated index receives the mean of its increments
+    :param table: 1d array modified in place
+    :param index: (n,) positions
+    :param increments: (n,) increments
+    """
+    unique, inverse, counts = np.unique(index, return_inverse=True, return_counts=True)
+    table[unique] += np.bincount(inverse, increments, len(unique)) / counts
 
 
 if __name__ == "__main__":
 
-    max_ep_length = 100
+    # cliff walking of example 6.6: 4x12, -1 each move, -100 and back to start on the cliff
+    rows, cols = 4, 12
+    S, A = rows * cols, 4
+    row, col = np.divmod(np.arange(S), cols)
+    moves = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+    start, goal = (rows - 1) * cols, rows * cols - 1
+
+    s = np.repeat(np.arange(S), A)
+    a = np.tile(np.arange(A), S)
+    s_next = (np.clip(row[s] + moves[a, 0], 0, rows - 1) * cols +
+              np.clip(col[s] + moves[a, 1], 0, cols - 1))
+    cliff = (s_next > start) & (s_next < goal)
+    cliff_walking = FiniteMDPenv.from_transitions(S, A, s, a, np.where(cliff, start, s_next),
+                                                  np.ones(len(s)), np.where(cliff, -100., -1.),
+                                                  terminal=np.arange(S) == goal,
+                                                  initial=np.eye(S)[start], seed=0)
+
+    for method in ("sarsa", "q_learning", "expected_sarsa"):
+        td = TDlearning(cliff_walking, num_envs=64, alpha=0.5, epsilon=0.1, seed=0)
+        start_time = time.perf_counter()
+        getattr(td, method)(2000)
+        elapsed = time.perf_counter() - start_time
+        print(f"{method}: mean return of the last 500 episodes {np.mean(td.episode_returns[-500:]):.1f}, "
+              f"{td.transitions / elapsed:,.0f} transitions/s")
+
+    def greedy_return(td, max_steps=100):
+        state, episode_return = np.array([start]), 0.
+        policy = td.greedy_policy()
+        for _ in range(max_steps):
+            state, reward, done = cliff_walking.batch_step(state, policy[state])
+            episode_return += reward[0]
+            if done[0]:
+                break
+        return episode_return
 
-    obs, terminal = TDlearning.reset()
+    # reuse of the real transitions, same 200 lockstep steps
+    for name, options in (("no reuse", {}),
+                          ("replay", {"replay": ReplayBuffer(10000, seed=0)}),
+                          ("prioritized replay", {"replay": ReplayBuffer(10000, True, seed=0)}),
+                          ("Dyna-Q", {"planning_steps": 5})):
+        td = TDlearning(cliff_walking, num_envs=8, alpha=0.5, epsilon=0.1, seed=0)
+        td.q_learning(200, **options)
+        print(f"q_learning with {name}: greedy policy return {greedy_return(td):.0f}")
 
-    while True:
+    for trace in ("accumulating", "replacing", "dutch"):
+        td = TDlearning(cliff_walking, num_envs=8, alpha=0.5, epsilon=0.1, seed=0)
+        td.sarsa_lambda(2000, lam=0.9, trace=trace)
+        print(f"sarsa(lambda) with {trace} traces: mean return of the last 500 episodes "
+              f"{np.mean(td.episode_returns[-500:]):.1f}")
 
-        if terminal:
-            break
\ No newline at end of file
+    # the terminal states of the gambler have no valid action, their bootstrap must be 0
+    from Environments import gambler
+    for method in ("q_learning", "expected_sarsa"):
+        td = TDlearning(gambler(cache_dir=None), num_envs=64, alpha=0.1, epsilon=0.1, seed=0)
+        getattr(td, method)(500)
+        assert np.all(np.isfinite(td.Q)), f"{method} on the gambler left non finite values in Q"
+        print(f"{method} on the gambler: Q finite, {len(td.episode_returns)} episodes")
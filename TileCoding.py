@@ -0,0 +1,383 @@
+"""
+linear function approximation, chapters 9 and 10: v(s,w) = w . x(s) and q(s,a,w) = w . x(s,a)
+with binary features x from tile coding, so a value is the sum of the weights of the
+active tiles and the semi-gradient update only touches them:
+w <- w + alpha [U_t - v(S_t,w)] grad v(S_t,w), grad v = x(S_t)
+the memory is the weight vector, whatever the number of states.
+
+tile coding: the feature space is covered by several tilings, grids offset from each
+other by a fraction of a tile (asymmetric offsets 1, 3, 5, ... in each dimension, pag.
+219); a point activates one tile per tiling. the tiles are hashed into a fixed size
+vector, so only the visited ones matter and collisions are rare when size is large enough.
+"""
+
+import numpy as np
+
+import Instrumentation
+from FiniteMDP import FiniteMDPenv
+from MonteCarlo import discounted_returns
+from TDlearning import LockstepTD, SparseTraces, scatter_mean_add
+from kArmedBandit import random_argmax
+
+
+# odd 64 bit multipliers of the tile hash, one for each coordinate and the tiling
+_HASH = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                  0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+                  0x94D049BB133111EB, 0xBF58476D1CE4E5B9], dtype=np.uint64)
+
+
+class TileCoder:
+    def __init__(self, low, high, tiles=8, tilings: int = 8, size: int = 4096,
+                 num_actions: int = None):
+        """
+        :param low: (d,) lower bounds of the features
+        :param high: (d,) upper bounds
+        :param tiles: tiles of each tiling along each dimension, scalar or (d,)
+        :param tilings: number of tilings n, the number of active features
+        :param size: length of the weight vector, better a power of 2
+        :param num_actions: for features of (state, action) pairs, the action is hashed too
+        """
+        self.low = np.asarray(low, dtype=float)
+        self.dims = len(self.low)
+        if self.dims + 2 > len(_HASH):
+            raise ValueError(f"at most {len(_HASH) - 2} feature dimensions")
+
+        self.scale = np.asarray(tiles, dtype=float) * tilings / (np.asarray(high, dtype=float) - self.low)
+        self.tilings = tilings
+        self.size = size
+        self.num_actions = num_actions
+
+        # (n, d) offset of each tiling, in units of 1/n of a tile
+        self._offsets = (np.arange(tilings)[:, None] * (2 * np.arange(self.dims) + 1)).astype(np.int64)
+        self._tiling_hash = np.arange(tilings, dtype=np.uint64) * _HASH[self.dims]
+
+    def _hash(self, x):
+        """
+        (B, n) uint64 hash of the active tile of each tiling, before the action
+        """
+        q = np.floor((np.asarray(x, dtype=float) - self.low) * self.scale).astype(np.int64)
+        coords = (q[:, None, :] + self._offsets) // self.tilings
+        h = coords.astype(np.uint64) * _HASH[:self.dims]
+
+        return h.sum(axis=2) + self._tiling_hash
+
+    def _index(self, h):
+        # final mixing of the bits, then the position in the weights
+        h ^= h >> np.uint64(31)
+        h *= _HASH[-1]
+        h ^= h >> np.uint64(29)
+
+        return (h % np.uint64(self.size)).astype(np.intp)
+
+    def active(self, x, actions=None):
+        """
+        :param x: (B, d) features
+        :param actions: (B,) actions, required when the coder has num_actions
+        :return: (B, n) indices of the active tiles
+        """
+        h = self._hash(x)
+        if actions is not None:
+            h += np.asarray(actions, dtype=np.uint64)[:, None] * _HASH[self.dims + 1]
+
+        return self._index(h)
+
+    def active_all(self, x):
+        """
+        :return: (B, A, n) indices of the active tiles of every action
+        """
+        h = self._hash(x)[:, None, :] + (np.arange(self.num_actions, dtype=np.uint64)[None, :, None] *
+                                         _HASH[self.dims + 1])
+
+        return self._index(h)
+
+
+class LinearTD(LockstepTD):
+    """
+    semi-gradient TD(0), TD(lambda), SARSA, SARSA(lambda), Q-learning and Expected SARSA with
+    tile coded linear values, on B lockstep environments with the same control loop and
+    replay of TDlearning, and gradient MC prediction. the states of the env are turned into features by
+    features(states) -> (B, d); no table of size |S| is allocated, also the exploration
+    over A(s) reads env.valid_actions directly. for the same reason there is no Dyna, its
+    model is a table of the (s, a) pairs.
+    alpha is the step size of a whole feature vector, each of the n active weights moves by
+    alpha / n, so alpha = 0.1 takes about 10 visits to learn a value (pag. 246)
+    """
+    def __init__(self, env, coder: TileCoder, features, num_envs: int = 1, alpha: float = 0.1,
+                 gamma: float = 1., epsilon: float = 0.1, seed=None):
+        """
+        :param env: a VectorEnv, or a FiniteMDPenv run as num_envs parallel episodes
+        :param coder: TileCoder with num_actions for the control methods
+        :param features: function of a (B,) array of states to the (B, d) features, or a
+        (S, d) array of the features of every state
+        """
+        super().__init__(env, num_envs, alpha, gamma, epsilon, seed)
+
+        self.coder = coder
+        self.features = features.__getitem__ if isinstance(features, np.ndarray) else features
+        # weights of q(s,a) and of v(s)
+        self.w = np.zeros(coder.size)
+        self.w_v = np.zeros(coder.size)
+
+    @property
+    def Q(self):
+        """ the control methods of LockstepTD return Q, here the weights of q(s,a,w) """
+        return self.w
+
+    def value(self, states):
+        """
+        :return: (B,) v(s,w)
+        """
+        return self.w_v[self.coder.active(self.features(states))].sum(axis=1)
+
+    def action_values(self, states):
+        """
+        :return: (B, A) q(s,a,w), -inf out of A(s)
+        """
+        values = self.w[self.coder.active_all(self.features(states))].sum(axis=2)
+        values[~self.env.valid_actions[states]] = -np.inf
+
+        return values
+
+    @Instrumentation.timed("linear.choose_action")
+    def choose_action(self, states, epsilon: float = None):
+        """
+        eps-greedy actions of q(s,a,w), ties broken at random
+        """
+        epsilon = self.epsilon if epsilon is None else epsilon
+        actions = random_argmax(self.action_values(states), self.rng)
+
+        if epsilon > 0:
+            explore = np.flatnonzero(self.rng.random(len(states)) < epsilon)
+            if len(explore):
+                valid = self.env.valid_actions[states[explore]]
+                cdf = np.cumsum(valid, axis=1) / np.maximum(valid.sum(axis=1, keepdims=True), 1)
+                u = self.rng.random((len(explore), 1))
+                actions[explore] = (cdf <= u).sum(axis=1).clip(max=valid.shape[1] - 1)
+
+        return actions
+
+    def _dyna_model(self):
+        raise ValueError("Dyna learns a table of the (s, a) pairs, with linear values use replay")
+
+    def _semi_gradient(self, w, active, delta):
+        """
+        w <- w + alpha / n delta on the (B, n) active tiles, a weight active in more
+        transitions of the batch gets the mean of their increments
+        """
+        n = active.shape[1]
+        scatter_mean_add(w, active.ravel(), np.repeat(self.alpha / n * delta, n))
+
+    def td0_prediction(self, policy, steps: int):
+        """
+        semi-gradient TD(0) for v_pi: w <- w + alpha [R + gamma v(S',w) - v(S,w)] x(S)
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param steps: lockstep steps, steps * B transitions
+        :return: the weights of v
+        """
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.cumsum(policy, axis=1)
+        self.env.reset()
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(
+                self._policy_actions(policy, self.env.obs))
+            active = self.coder.active(self.features(states))
+            next_values = np.where(done, 0., self.value(next_states))
+            delta = rewards + self.gamma * next_values - self.w_v[active].sum(axis=1)
+            self._semi_gradient(self.w_v, active, delta)
+
+        return self.w_v
+
+    def gradient_mc_prediction(self, policy, episodes: int, max_ep_length: int = 1000):
+        """
+        gradient MC for v_pi (pag. 202): w <- w + alpha [G_t - v(S_t,w)] x(S_t) for every
+        step, applied when an episode ends with the returns of all his steps. the B envs
+        write their running episode in a (B, max_ep_length) buffer, longer episodes are cut
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param episodes: episodes to learn from
+        :return: the weights of v
+        """
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.cumsum(policy, axis=1)
+        B, T = self.num_envs, max_ep_length
+        states = np.zeros((B, T), dtype=np.intp)
+        rewards = np.zeros((B, T))
+        t = np.zeros(B, dtype=np.intp)
+        rows = np.arange(B)
+
+        self.env.reset()
+        finished = 0
+        while finished < episodes:
+            s, _, r, done = self._step(self._policy_actions(policy, self.env.obs))
+            states[rows, t] = s
+            rewards[rows, t] = r
+            t += 1
+
+            truncated = ~done & (t == T)
+            self.env.reset_envs(np.flatnonzero(truncated))
+            ended = np.flatnonzero(done | truncated)[:episodes - finished]
+            if len(ended):
+                lengths = t[ended]
+                valid = np.arange(T) < lengths[:, None]
+                G = discounted_returns(rewards[ended] * valid, self.gamma)[valid]
+                active = self.coder.active(self.features(states[ended][valid]))
+                self._semi_gradient(self.w_v, active, G - self.w_v[active].sum(axis=1))
+
+                t[ended] = 0
+                finished += len(ended)
+
+        return self.w_v
+
+    def _next_values(self, next_states, method: str):
+        values = self.action_values(next_states)
+        best = values.max(axis=1)
+        if method == "q_learning":
+            return best
+
+        valid = np.isfinite(values)
+        mean = np.where(valid, values, 0).sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+        return (1 - self.epsilon) * best + self.epsilon * mean
+
+    @Instrumentation.timed("linear.update")
+    def _update(self, states, actions, rewards, next_states, done, method: str,
+                next_actions=None, weights=None):
+        """
+        one semi-gradient update of a batch of transitions, only the active tiles move
+        :return: the TD errors
+        """
+        if method == "sarsa":
+            next_values = self.w[self.coder.active(self.features(next_states), next_actions)].sum(axis=1)
+        else:
+            next_values = self._next_values(next_states, method)
+
+        active = self.coder.active(self.features(states), actions)
+        delta = rewards + self.gamma * np.where(done, 0., next_values) - self.w[active].sum(axis=1)
+        self._semi_gradient(self.w, active, delta if weights is None else weights * delta)
+
+        return delta
+
+    def _trace_update(self, w, traces, active, delta, lam: float, done):
+        """
+        bump the traces of the (B, n) active tiles, move every traced weight by
+        alpha / n delta z and decay the traces by gamma lambda
+        """
+        n = active.shape[1]
+        traces.visit(np.repeat(np.arange(self.num_envs), n), active.ravel(), self.alpha / n)
+        scatter_mean_add(w, traces.index, self.alpha / n * delta[traces.envs] * traces.values)
+        traces.decay(self.gamma * lam, done)
+
+    def td_lambda(self, policy, steps: int, lam: float = 0.9, trace: str = "accumulating",
+                  threshold: float = 1e-3):
+        """
+        semi-gradient TD(lambda) for v_pi (pag. 293): z <- gamma lambda z + x(S),
+        w <- w + alpha delta z. the traces are SparseTraces on the weights, so a step touches
+        the tiles active in the last log(threshold) / log(gamma lambda) steps of each env;
+        the dutch rule is applied to each tile with alpha / n
+        :param policy: (S,) deterministic or (S, A) stochastic policy
+        :param steps: lockstep steps, steps * B transitions
+        :param lam: trace decay lambda
+        :param trace: "accumulating", "replacing" or "dutch"
+        :param threshold: traces below it are dropped
+        :return: the weights of v
+        """
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.cumsum(policy, axis=1)
+        traces = SparseTraces(self.coder.size, trace, threshold)
+        self.env.reset()
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(
+                self._policy_actions(policy, self.env.obs))
+            active = self.coder.active(self.features(states))
+            next_values = np.where(done, 0., self.value(next_states))
+            delta = rewards + self.gamma * next_values - self.w_v[active].sum(axis=1)
+            self._trace_update(self.w_v, traces, active, delta, lam, done)
+
+        return self.w_v
+
+    def sarsa_lambda(self, steps: int, lam: float = 0.9, trace: str = "replacing",
+                     threshold: float = 1e-3):
+        """
+        semi-gradient SARSA(lambda) (pag. 305), the traces on the tiles of x(S, A) as in
+        td_lambda
+        :param steps: lockstep steps, steps * B transitions
+        :param lam: trace decay lambda
+        :param trace: "accumulating", "replacing" or "dutch"
+        :param threshold: traces below it are dropped
+        :return: the weights of q
+        """
+        traces = SparseTraces(self.coder.size, trace, threshold)
+        self.env.reset()
+        actions = self.choose_action(self.env.obs)
+
+        for _ in range(steps):
+            states, next_states, rewards, done = self._step(actions)
+            next_actions = self.choose_action(self.env.obs)
+
+            active = self.coder.active(self.features(states), actions)
+            next_values = self.w[self.coder.active(self.features(next_states), next_actions)].sum(axis=1)
+            delta = rewards + self.gamma * np.where(done, 0., next_values) - self.w[active].sum(axis=1)
+            self._trace_update(self.w, traces, active, delta, lam, done)
+
+            actions = next_actions
+
+        return self.w
+
+    def greedy_policy(self, states=None):
+        """
+        :param states: states to evaluate, all of them by default
+        :return: greedy actions of q(s,a,w)
+        """
+        states = np.arange(self.env.num_states) if states is None else np.asarray(states)
+        return self.action_values(states).argmax(axis=1)
+
+
+if __name__ == "__main__":
+    import time
+
+    from DynamicProgr import DynamicProgramming
+    from Environments import gridworld
+
+    # 1000 state random walk of example 9.1: jumps of 1...100 to the left or right, the
+    # ends are terminal with reward -1 and +1, start in the middle
+    S = 1002
+    s = np.repeat(np.arange(1, S - 1), 200)
+    jump = np.tile(np.concatenate([-np.arange(1, 101), np.arange(1, 101)]), S - 2)
+    s_next = np.clip(s + jump, 0, S - 1)
+    ends = np.sign(s_next - S // 2) * np.isin(s_next, [0, S - 1])
+    walk = FiniteMDPenv.from_transitions(S, 1, s, np.zeros(len(s), dtype=int), s_next,
+                                         np.full(len(s), 1 / 200), ends,
+                                         terminal=np.isin(np.arange(S), [0, S - 1]),
+                                         initial=np.eye(S)[S // 2])
+    v_true = DynamicProgramming(walk, gamma=1.).policy_evaluation(np.zeros(S, dtype=int), method="direct")
+
+    # 50 tilings of 200 states wide tiles, as in figure 9.10
+    positions = np.arange(S, dtype=float)[:, None]
+    live = np.arange(1, S - 1)
+    for method, alpha, amount in (("td0_prediction", 0.2, 3000), ("td_lambda", 0.05, 1500),
+                                  ("gradient_mc_prediction", 0.01, 2000)):
+        coder = TileCoder([0.], [S], tiles=S / 200, tilings=50, size=2048)
+        td = LinearTD(walk, coder, positions, num_envs=64, alpha=alpha, seed=0)
+        start = time.perf_counter()
+        getattr(td, method)(np.zeros(S, dtype=int), amount)
+        elapsed = time.perf_counter() - start
+        rmse = np.sqrt(np.mean((td.value(live) - v_true[live]) ** 2))
+        print(f"random walk, {method}: RMS error {rmse:.3f} with {coder.size} weights, "
+              f"{td.transitions / elapsed:,.0f} transitions/s")
+
+    # semi-gradient SARSA on a 100 x 100 gridworld with a single goal, features (row, col)
+    n = 100
+    grid = gridworld(n, n, terminals=[n * n - 1], cache_dir=None)
+    coder = TileCoder([0, 0], [n, n], tiles=5, tilings=8, size=4096, num_actions=4)
+    td = LinearTD(grid, coder, lambda states: np.stack(np.divmod(states, n), axis=1), num_envs=256,
+                  alpha=0.5, epsilon=0.1, seed=0)
+    start = time.perf_counter()
+    td.sarsa(4000)
+    elapsed = time.perf_counter() - start
+    print(f"gridworld {n * n} states, semi-gradient sarsa: mean return of the last 500 episodes "
+          f"{np.mean(td.episode_returns[-500:]):.1f} (optimal from a random start {1 - n}), "
+          f"{td.w.nbytes / 1024:.0f} KB of weights instead of {grid.num_states * 4 * 8 / 2 ** 20:.1f} MB "
+          f"of Q, {td.transitions / elapsed:,.0f} transitions/s")
@@ -0,0 +1,258 @@
+"""
+append only columnar log of episodes S0, A0, R1, S1, A1, R2, ... on disk.
+the steps of all the episodes are concatenated in fixed dtype columns (states, actions,
+rewards) and an offsets column gives where each episode starts, so episode i is
+[offsets[i], offsets[i+1]) of every column. the log is split in chunks of about
+chunk_steps steps, each chunk is a group of .npy files that are opened with np.memmap, so
+reading never copies a whole log in RAM; compressed chunks are a single .npz, smaller on
+disk but decompressed one chunk at a time when read.
+
+    with TrajectoryWriter("logs/behaviour") as log:
+        log.add_episodes(*mc.generate_episodes(10000, behaviour))
+    store = TrajectoryStore("logs/behaviour")
+    for states, actions, rewards, lengths in store.batches(1000):
+        ...
+
+meta.json lists the columns with their dtype and the chunks with their size; it is
+rewritten after every chunk, so a crash loses at most the steps still in the buffer.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+COLUMNS = {"states": np.int32, "actions": np.int16, "rewards": np.float32}
+
+
+class TrajectoryWriter:
+    def __init__(self, directory: str, chunk_steps: int = 2 ** 20, compress: bool = False,
+                 dtypes: dict = None):
+        """
+        open a log for appending, a new one or the continuation of an existing one
+        :param directory: directory of the log
+        :param chunk_steps: steps buffered before a chunk is written
+        :param compress: write compressed .npz chunks instead of memory mappable .npy ones
+        :param dtypes: column -> dtype, to override COLUMNS (e.g. float64 rewards); an
+        existing log keeps his own
+        """
+        self.directory = directory
+        self.chunk_steps = chunk_steps
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, "meta.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.meta = json.load(f)
+        else:
+            columns = {**COLUMNS, **(dtypes or {})}
+            self.meta = {"columns": {name: np.dtype(dtype).str for name, dtype in columns.items()},
+                         "chunks": []}
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in self.meta["columns"].items()}
+
+        self._buffer = {name: [] for name in self.dtypes}
+        self._lengths = []
+        self._buffered = 0
+
+    def add_episodes(self, states, actions, rewards, lengths):
+        """
+        append a batch of padded episodes, the output of MonteCarlo.generate_episodes
+        :param states: (E, T_max) S_t
+        :param actions: (E, T_max) A_t
+        :param rewards: (E, T_max) R_(t+1)
+        :param lengths: (E,) episode lengths
+        """
+        lengths = np.asarray(lengths)
+        valid = np.arange(np.shape(states)[1]) < lengths[:, None]
+        self._append({"states": np.asarray(states)[valid], "actions": np.asarray(actions)[valid],
+                      "rewards": np.asarray(rewards)[valid]}, lengths)
+
+    def add_episode(self, states, actions, rewards):
+        """
+        append one episode given as three sequences of the same length T
+        """
+        self._append({"states": np.asarray(states), "actions": np.asarray(actions),
+                      "rewards": np.asarray(rewards)}, np.array([len(states)]))
+
+    def _append(self, columns: dict, lengths):
+        for name, dtype in self.dtypes.items():
+            values = columns[name]
+            if dtype.kind in "iu" and len(values) and (values.min() < np.iinfo(dtype).min or
+                                                       values.max() > np.iinfo(dtype).max):
+                raise ValueError(f"{name} do not fit in {dtype}")
+            self._buffer[name].append(values.astype(dtype, copy=False))
+        self._lengths.append(lengths)
+        self._buffered += int(lengths.sum())
+
+        if self._buffered >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        """
+        write the buffered episodes as a new chunk
+        """
+        if not self._lengths:
+            return
+
+        lengths = np.concatenate(self._lengths)
+        arrays = {name: np.concatenate(parts) for name, parts in self._buffer.items()}
+        arrays["offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        name = f"chunk-{len(self.meta['chunks']):06d}"
+        if self.compress:
+            np.savez_compressed(os.path.join(self.directory, name + ".npz"), **arrays)
+        else:
+            for column, array in arrays.items():
+                np.save(os.path.join(self.directory, f"{name}.{column}.npy"), array)
+
+        self.meta["chunks"].append({"name": name, "episodes": len(lengths),
+                                    "steps": int(arrays["offsets"][-1]), "compressed": self.compress})
+        with open(os.path.join(self.directory, "meta.json.tmp"), "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(os.path.join(self.directory, "meta.json.tmp"),
+                   os.path.join(self.directory, "meta.json"))
+
+        self._buffer = {name: [] for name in self.dtypes}
+        self._lengths = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryStore:
+    def __init__(self, directory: str):
+        """
+        read only view of a log written by TrajectoryWriter
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        self.chunk_episodes = np.array([c["episodes"] for c in self.meta["chunks"]], dtype=np.int64)
+        self.num_episodes = int(self.chunk_episodes.sum())
+        self.num_steps = sum(c["steps"] for c in self.meta["chunks"])
+        self._first_episode = np.concatenate([[0], np.cumsum(self.chunk_episodes)])
+
+    def __len__(self):
+        return self.num_episodes
+
+    def chunk(self, index: int):
+        """
+        :return: dict of the columns of a chunk and his offsets, memory mapped .npy files or
+        arrays decompressed from the .npz
+        """
+        info = self.meta["chunks"][index]
+        if info["compressed"]:
+            with np.load(os.path.join(self.directory, info["name"] + ".npz")) as data:
+                return {name: data[name] for name in data.files}
+
+        return {name: np.load(os.path.join(self.directory, f"{info['name']}.{name}.npy"),
+                              mmap_mode="r")
+                for name in [*self.meta["columns"], "offsets"]}
+
+    def chunks(self):
+        for index in range(len(self.meta["chunks"])):
+            yield self.chunk(index)
+
+    def episode(self, i: int):
+        """
+        :return: states, actions and rewards of episode i
+        """
+        index = int(np.searchsorted(self._first_episode, i, side="right")) - 1
+        columns = self.chunk(index)
+        start, end = columns["offsets"][i - self._first_episode[index]:][:2]
+
+        return tuple(np.array(columns[name][start:end]) for name in ("states", "actions", "rewards"))
+
+    def batches(self, batch_size: int = 1000, max_length: int = None):
+        """
+        the episodes in order as padded batches, ready for MonteCarlo.batch_update and
+        off_policy_update. only one batch is in RAM at a time
+        :param batch_size: episodes of each batch, the last batch of a chunk can be shorter
+        :param max_length: T_max of the padding, the longest episode of the batch by default
+        :return: generator of (E, T_max) states, actions and rewards and (E,) lengths
+        """
+        for columns in self.chunks():
+            offsets = columns["offsets"]
+            for first in range(0, len(offsets) - 1, batch_size):
+                starts = np.asarray(offsets[first:first + batch_size + 1])
+                lengths = np.diff(starts)
+                T = int(lengths.max()) if max_length is None else max_length
+
+                rows = np.repeat(np.arange(len(lengths)), lengths)
+                cols = np.arange(starts[-1] - starts[0]) - np.repeat(starts[:-1] - starts[0], lengths)
+                padded = []
+                for name, dtype in (("states", np.intp), ("actions", np.intp), ("rewards", float)):
+                    array = np.zeros((len(lengths), T), dtype=dtype)
+                    array[rows, cols] = columns[name][starts[0]:starts[-1]]
+                    padded.append(array)
+
+                yield (*padded, lengths)
+
+    def transitions(self):
+        """
+        the steps of each chunk as (S, A, R, S', done) arrays for ReplayBuffer.add; the
+        log has no final state, so the last step of each episode is done with S' = S
+        (a truncated episode is treated as terminated)
+        """
+        for columns in self.chunks():
+            states = np.asarray(columns["states"], dtype=np.intp)
+            done = np.zeros(len(states), dtype=bool)
+            done[np.asarray(columns["offsets"][1:]) - 1] = True
+            next_states = np.where(done, states, np.roll(states, -1))
+
+            yield (states, np.asarray(columns["actions"], dtype=np.intp),
+                   np.asarray(columns["rewards"], dtype=float), next_states, done)
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import time
+
+    from DynamicProgr import DynamicProgramming
+    from Environments import blackjack
+    from MonteCarlo import MonteCarlo
+
+    # log episodes of the equiprobable policy on blackjack, then evaluate offline the
+    # policy that sticks only on 20 and 21 (example 5.4 pag. 106 style)
+    env = blackjack(cache_dir=None)
+    behaviour = np.full((env.num_states, 2), 0.5)
+    target = np.ones(env.num_states, dtype=int)
+    target[:200] = (np.arange(200) // 20 + 12 < 20)
+
+    directory = tempfile.mkdtemp()
+    for compress in (False, True):
+        path = os.path.join(directory, "compressed" if compress else "raw")
+        mc = MonteCarlo(env, max_ep_length=20, num_envs=1000, seed=0)
+
+        start = time.perf_counter()
+        with TrajectoryWriter(path, chunk_steps=100000, compress=compress) as log:
+            for _ in range(50):
+                log.add_episodes(*mc.generate_episodes(10000, behaviour))
+        written = time.perf_counter() - start
+
+        store = TrajectoryStore(path)
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+        start = time.perf_counter()
+        Q, _ = MonteCarlo(env, max_ep_length=20, seed=0).off_policy_evaluation(store, target, behaviour)
+        read = time.perf_counter() - start
+
+        V = np.take_along_axis(Q, target[:, None], axis=1)[:, 0]
+        exact = DynamicProgramming(env, 1.).policy_evaluation(target)
+        print(f"{'compressed' if compress else 'raw'}: {store.num_episodes} episodes, "
+              f"{store.num_steps} steps, {size / 2 ** 20:.1f} MB in {len(store.meta['chunks'])} chunks, "
+              f"written in {written:.2f}s, evaluated in {read:.2f}s, "
+              f"mean start value {env.initial @ V:.3f} (exact {env.initial @ exact:.3f})")
+
+    shutil.rmtree(directory)
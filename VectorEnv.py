@@ -0,0 +1,258 @@
+import numpy as np
+
+import Instrumentation
+
+
+class VectorEnv:
+    """
+    B environments stepped together, the common protocol of all the learners.
+    reset(seed) starts all of them, step(actions) takes one action for each and returns the
+    observations, rewards and done flags in preallocated arrays that are overwritten by the
+    next call (copy them to keep them).
+    a sub environment that finishes an episode is reset at once: obs already holds the first
+    state of the new episode, final_obs the state where the old one ended.
+    observations are state indices of a finite state space of num_states states, with
+    num_actions actions and the valid_actions (S, A) mask of A(s).
+    the returns of the finished episodes are counted and summed, and the last keep_returns
+    of them are kept in a ring, so a long run does not grow the memory.
+
+    subclasses implement _reset(index) and _step(actions, index), and seed(seed).
+    """
+    def __init__(self, num_envs: int, num_states: int, num_actions: int, valid_actions=None,
+                 keep_returns: int = 10000):
+        self.num_envs = num_envs
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.valid_actions = (np.ones((num_states, num_actions), dtype=bool)
+                              if valid_actions is None else np.asarray(valid_actions, dtype=bool))
+
+        self.obs = np.zeros(num_envs, dtype=np.intp)
+        self.final_obs = np.zeros(num_envs, dtype=np.intp)
+        self.rewards = np.zeros(num_envs)
+        self.dones = np.zeros(num_envs, dtype=bool)
+
+        # undiscounted return of the running episodes, ring of the last finished ones
+        self._returns = np.zeros(num_envs)
+        self._finished_returns = np.zeros(keep_returns)
+        self.episodes_finished = 0
+        self.returns_sum = 0.
+
+    def seed(self, seed):
+        raise NotImplementedError
+
+    def _reset(self, index):
+        """
+        :param index: (n,) sub environments to reset
+        :return: (n,) their initial states, never terminal
+        """
+        raise NotImplementedError
+
+    def _step(self, actions, index):
+        """
+        :param actions: (n,) actions
+        :param index: (n,) sub environments that take them, or slice(None) for all
+        :return: (n,) next states, rewards and terminal flags
+        """
+        raise NotImplementedError
+
+    @property
+    def episode_returns(self):
+        """
+        :return: the returns of the last keep_returns finished episodes, oldest first
+        """
+        keep = len(self._finished_returns)
+        if self.episodes_finished <= keep:
+            return self._finished_returns[:self.episodes_finished].copy()
+        return np.roll(self._finished_returns, -(self.episodes_finished % keep))
+
+    def _record_returns(self, returns):
+        keep = len(self._finished_returns)
+        self.episodes_finished += len(returns)
+        self.returns_sum += float(returns.sum())
+        if keep:
+            # only the last keep returns go to the ring, in the slots of their episode number
+            kept = returns[-keep:]
+            slots = (self.episodes_finished - len(kept) + np.arange(len(kept))) % keep
+            self._finished_returns[slots] = kept
+
+    def reset(self, seed=None):
+        """
+        start a new episode in every sub environment
+        :param seed: reseed the environments first, if given
+        :return: (B,) initial states
+        """
+        if seed is not None:
+            self.seed(seed)
+
+        self.obs[:] = self._reset(np.arange(self.num_envs))
+        self._returns[:] = 0
+
+        return self.obs
+
+    def reset_envs(self, index):
+        """
+        start a new episode only in some sub environments, e.g. to truncate long episodes
+        :param index: (n,) sub environments
+        """
+        if len(index):
+            self.obs[index] = self._reset(index)
+            self._returns[index] = 0
+
+    @Instrumentation.timed("vector_env.step")
+    def step(self, actions, index=None):
+        """
+        one time step of every sub environment, the finished ones are reset
+        :param actions: (B,) actions, or (n,) with index
+        :param index: (n,) sub environments to step, None for all; the others keep their
+        state, with reward 0 and not done
+        :return: (B,) observations, rewards and done flags
+        """
+        if index is None:
+            index = slice(None)
+        else:
+            self.final_obs[:] = self.obs
+            self.rewards[:] = 0
+            self.dones[:] = False
+
+        next_obs, rewards, dones = self._step(actions, index)
+        self.final_obs[index] = next_obs
+        self.rewards[index] = rewards
+        self.dones[index] = dones
+        self.obs[index] = next_obs
+
+        self._returns += self.rewards
+        if self.dones.any():
+            done = np.flatnonzero(self.dones)
+            self._record_returns(self._returns[done])
+            self.reset_envs(done)
+
+        return self.obs, self.rewards, self.dones
+
+    def close(self):
+        pass
+
+
+class MDPVectorEnv(VectorEnv):
+    """
+    B episodes of a FiniteMDPenv, every step is one batch_step of the model
+    """
+    def __init__(self, mdp, num_envs: int = 1, seed=None):
+        super().__init__(num_envs, mdp.num_states, mdp.num_actions, mdp.valid_actions)
+        self.mdp = mdp
+        self.terminal = mdp.terminal
+        self.rng = np.random.default_rng(seed)
+
+    def seed(self, seed):
+        self.rng = np.random.default_rng(seed)
+
+    def _reset(self, index):
+        states, _ = self.mdp.reset(len(index), rng=self.rng)
+
+        # an initial state can be terminal, draw again
+        terminal = self.terminal[states]
+        while np.any(terminal):
+            states[terminal], _ = self.mdp.reset(np.count_nonzero(terminal), rng=self.rng)
+            terminal = self.terminal[states]
+
+        return states
+
+    def _step(self, actions, index):
+        return self.mdp.batch_step(self.obs[index], actions, rng=self.rng)
+
+
+class SubprocVectorEnv(VectorEnv):
+    """
+    scalar environments, with reset() -> (state, terminal) and step(action) -> (state,
+    reward, terminal) like FiniteMDPenv, run in worker processes. the env_fns are split
+    among the workers, each step sends every worker the actions of his environments and
+    waits for all the answers, so the environments of different workers run in parallel.
+    the first environment also gives num_states, num_actions and valid_actions if it has them
+    """
+    def __init__(self, env_fns, workers: int = None, seed=None):
+        import multiprocessing
+
+        workers = min(len(env_fns), workers or multiprocessing.cpu_count())
+        self._slices = np.array_split(np.arange(len(env_fns)), workers)
+
+        context = multiprocessing.get_context()
+        self._pipes, self._processes = [], []
+        for part in self._slices:
+            parent, child = context.Pipe()
+            process = context.Process(target=_subproc_worker, daemon=True,
+                                      args=(child, [env_fns[i] for i in part]))
+            process.start()
+            child.close()
+            self._pipes.append(parent)
+            self._processes.append(process)
+
+        self._pipes[0].send(("spaces", None))
+        num_states, num_actions, valid_actions = self._pipes[0].recv()
+        super().__init__(len(env_fns), num_states, num_actions, valid_actions)
+
+        if seed is not None:
+            self.seed(seed)
+
+    def _call(self, command: str, arguments):
+        for pipe, argument in zip(self._pipes, arguments):
+            pipe.send((command, argument))
+        return [pipe.recv() for pipe in self._pipes]
+
+    def seed(self, seed):
+        seeds = np.random.SeedSequence(seed).spawn(self.num_envs)
+        self._call("seed", [[seeds[i] for i in part] for part in self._slices])
+
+    def _reset(self, index):
+        wanted = [np.intersect1d(part, index) - part[0] for part in self._slices]
+        obs = self._call("reset", wanted)
+        states = np.empty(self.num_envs, dtype=np.intp)
+        for part, local, values in zip(self._slices, wanted, obs):
+            states[part[0] + local] = values
+
+        return states[index]
+
+    def _step(self, actions, index):
+        index = np.arange(self.num_envs)[index]
+        wanted = [(index >= part[0]) & (index <= part[-1]) for part in self._slices]
+        results = self._call("step", [(index[mask] - part[0], actions[mask])
+                                      for part, mask in zip(self._slices, wanted)])
+
+        next_obs = np.empty(len(index), dtype=np.intp)
+        rewards = np.empty(len(index))
+        dones = np.empty(len(index), dtype=bool)
+        for mask, result in zip(wanted, results):
+            if len(result):
+                next_obs[mask], rewards[mask], dones[mask] = result
+
+        return next_obs, rewards, dones
+
+    def close(self):
+        for pipe in self._pipes:
+            pipe.send(("close", None))
+        for process in self._processes:
+            process.join(timeout=5)
+
+
+def _subproc_worker(pipe, env_fns):
+    """
+    body of the SubprocVectorEnv workers, it serves the commands of the pipe
+    """
+    envs = [fn() for fn in env_fns]
+
+    while True:
+        command, argument = pipe.recv()
+
+        if command == "step":
+            results = [envs[i].step(action) for i, action in zip(*argument)]
+            pipe.send(tuple(np.array(column) for column in zip(*results)))
+        elif command == "reset":
+            pipe.send(np.array([envs[i].reset()[0] for i in argument], dtype=np.intp))
+        elif command == "seed":
+            for env, seed in zip(envs, argument):
+                env.rng = np.random.default_rng(seed)
+            pipe.send(None)
+        elif command == "spaces":
+            env = envs[0]
+            pipe.send((env.num_states, env.num_actions, getattr(env, "valid_actions", None)))
+        elif command == "close":
+            pipe.close()
+            break
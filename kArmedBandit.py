@@ -1,5 +1,12 @@
+import hashlib
+import json
+import os
+import sys
+
 import numpy as np
-from scipy.stats import norm
+
+import Instrumentation
+
 
 class BanditEnv:
     """
@@ -86,28 +93,469 @@ class BanditEnv:
     plot with average reward over 1000 steps and on x values of parameters
 every curve has the parameters chosen see page 63 for the example.
     """
-    def __init__(self, n: int = 1):
+    def __init__(self, n: int = 10, num_envs: int = 1, means=None, sd: float = 1., seed=None):
+        """
+        batched testbed, num_envs independent k-armed bandits simulated together
+        :param n: number of arms k
+        :param num_envs: number of independent testbeds B, each one with his own arm means
+        :param means: personalized means, shape (k,) shared by all testbeds or (B, k);
+        if None every mean is drawn from a normal(0, 1) as in the book
+        :param sd: standard deviation of the reward distributions
+        :param seed: seed or np.random.Generator used for both the means and the rewards
+        """
         self.arms_number = n
+        self.num_envs = num_envs
+        self.sd = sd
+        self.rng = np.random.default_rng(seed)
+        self.means = means
+
+        # (B, k) true values q*(a) of each testbed and the best arm of each one
+        self.rand_mean_vector = np.empty((num_envs, n))
+        self.optimal_actions = np.empty(num_envs, dtype=np.intp)
 
-        self.rand_mean_vector = np.random.random_sample()
+        self._rows = np.arange(num_envs)
+        self._noise = np.empty(num_envs)
 
-        reward = 0
+        self.reset()
 
+    @Instrumentation.timed("bandit.lever_pull")
+    def lever_pull(self, arm):
+        """
+        pull one lever in every testbed, all the rewards come from a single vectorized draw
+        :param arm: vector of B actions, one for each testbed (a scalar is fine when B = 1)
+        :return: the B rewards, or a float if a scalar arm was given
+        """
+        if np.ndim(arm) == 0:
+            return float(self.rng.normal(self.rand_mean_vector[0, arm], self.sd))
 
-    def lever_pull(self, arm: int = None):
+        self.rng.standard_normal(out=self._noise)
+        self._noise *= self.sd
+        self._noise += self.rand_mean_vector[self._rows, arm]
 
-        mean, sd = 0, 1
-        r = norm.rvs(loc=mean, scale=sd, size=1)
+        return self._noise.copy()
 
     def reset(self):
-        pass
+        """
+        draw new true values for every testbed, or restore the personalized ones
+        :return: the (B,) vector with the optimal arm of each testbed
+        """
+        if self.means is None:
+            self.rng.standard_normal(out=self.rand_mean_vector)
+        else:
+            self.rand_mean_vector[:] = self.means
+
+        self.rand_mean_vector.argmax(axis=1, out=self.optimal_actions)
+
+        return self.optimal_actions
+
+class NonStationaryBanditEnv(BanditEnv):
+    """
+    the true values take independent random walks: after every pull each q*(a) of every
+    testbed gets a normal(0, walk_sd) increment. All the means start equal (at 0, or at the
+    personalized ones), as in exercise 2.5 to show that sample average has difficulty here.
+    the increments are drawn in chunks of steps into a preallocated buffer and the (B, k)
+    means are modified in place
+    """
+    def __init__(self, n: int = 10, num_envs: int = 1, means=None, sd: float = 1.,
+                 walk_sd: float = 0.01, chunk: int = None, seed=None):
+        """
+        :param walk_sd: standard deviation of the random walk increments
+        :param chunk: number of steps of increments drawn at once, by default as many as fit
+        in about 8 MB
+        """
+        self.walk_sd = walk_sd
+        if chunk is None:
+            chunk = max(1, 2 ** 20 // (num_envs * n))
+        self._walk = np.empty((chunk, num_envs, n))
+        self._cursor = chunk
+
+        super().__init__(n, num_envs, np.zeros(n) if means is None else means, sd, seed)
+
+    def lever_pull(self, arm):
+        """
+        reward from the current means, then every mean moves one step of the walk
+        """
+        rewards = super().lever_pull(arm)
+
+        if self._cursor == len(self._walk):
+            self.rng.standard_normal(out=self._walk)
+            self._walk *= self.walk_sd
+            self._cursor = 0
+
+        self.rand_mean_vector += self._walk[self._cursor]
+        self._cursor += 1
+        self.rand_mean_vector.argmax(axis=1, out=self.optimal_actions)
+
+        return rewards
+
+
+def random_argmax(values, rng):
+    """
+    argmax over the last axis breaking ties at random, for all the rows at once.
+    every maximum gets a uniform random key and the largest key wins, so there is no
+    per-row np.random.choice
+    :param values: (B, k) array
+    :param rng: np.random.Generator
+    :return: (B,) indices of the chosen maxima
+    """
+    ties = values == values.max(axis=-1, keepdims=True)
+    keys = rng.random(values.shape)
+    keys[~ties] = -1.
+
+    return keys.argmax(axis=-1)
+
 
 class BanditOptimization:
-    def __init__(self):
-        self.action_value_table = None
+    """
+    Action value methods with eps-greedy selection, for B parallel runs: every table is (B, k)
+    and row i belongs to the testbed i of a BanditEnv with num_envs=B.
+
+    sample average: alpha=None, step size 1/N(a)
+    constant step size: alpha in (0, 1], good for non-stationary problems
+    unbiased constant step size: alpha and unbiased=True, step size beta = alpha / o_n with
+    o_n = o_(n-1) + alpha (1 - o_(n-1)), o_0 = 0
+    optimistic initial values: q1 > 0, e.g. q1=5 with eps=0, it pushes the early exploration
+    but it is not useful for non-stationary problems
+    """
+    def __init__(self, n: int = 10, num_envs: int = 1, epsilon: float = 0., alpha: float = None,
+                 unbiased: bool = False, q1: float = 0., seed=None):
+        self.arms_number = n
+        self.num_envs = num_envs
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.unbiased = unbiased
+        self.q1 = q1
+        self.rng = np.random.default_rng(seed)
+
+        if unbiased and alpha is None:
+            raise ValueError("the unbiased step size needs a constant alpha")
+
+        self.action_value_table = np.empty((num_envs, n))
+        self.action_counts = np.empty((num_envs, n))
+        self.trace = np.empty((num_envs, n)) if unbiased else None
+        self.t = 0
+
+        self._rows = np.arange(num_envs)
+
+        self.reset()
+
+    def reset(self):
+        """
+        back to Q_1(a) = q1 and N(a) = 0 for every run
+        """
+        self.action_value_table.fill(self.q1)
+        self.action_counts.fill(0)
+        if self.trace is not None:
+            self.trace.fill(0)
+        self.t = 0
+
+    @Instrumentation.timed("bandit.choose_action")
+    def choose_action(self):
+        """
+        A <- {argmax Q(a) with P(1-eps) or random a with P(eps)}, for every run
+        :return: (B,) actions
+        """
+        actions = random_argmax(self.action_value_table, self.rng)
+
+        if self.epsilon > 0:
+            explore = self.rng.random(self.num_envs) < self.epsilon
+            actions[explore] = self.rng.integers(self.arms_number, size=np.count_nonzero(explore))
+
+        return actions
+
+    def step_size(self, actions):
+        """
+        step size of the pulled arms, the counts must be already updated
+        :param actions: (B,) pulled arms
+        :return: (B,) step sizes
+        """
+        if self.alpha is None:
+            return 1 / self.action_counts[self._rows, actions]
+
+        if not self.unbiased:
+            return self.alpha
+
+        o = self.trace[self._rows, actions]
+        o += self.alpha * (1 - o)
+        self.trace[self._rows, actions] = o
+
+        return self.alpha / o
+
+    @Instrumentation.timed("bandit.action_value_update")
+    def action_value_update(self, actions, rewards):
+        """
+        N(A) <- N(A) + 1
+        Q(A) <- Q(A) + step_size [R - Q(A)]
+        :param actions: (B,) pulled arms
+        :param rewards: (B,) rewards received
+        """
+        self.t += 1
+        self.action_counts[self._rows, actions] += 1
+
+        q = self.action_value_table[self._rows, actions]
+        q += self.step_size(actions) * (rewards - q)
+        self.action_value_table[self._rows, actions] = q
+
+
+class UCBBandit(BanditOptimization):
+    """
+    A_t = argmax(a) [Q_t(a) + c * sqrt((ln t)/(N_t(a)))]
+    an arm with N_t(a) = 0 is a maximizing action, so every arm is pulled once at the start
+    """
+    def __init__(self, n: int = 10, num_envs: int = 1, c: float = 2., alpha: float = None,
+                 unbiased: bool = False, q1: float = 0., seed=None):
+        self.c = c
+        super().__init__(n, num_envs, 0., alpha, unbiased, q1, seed)
+
+    @Instrumentation.timed("bandit.choose_action")
+    def choose_action(self):
+        """
+        :return: (B,) actions with the highest upper confidence bound
+        """
+        counts = self.action_counts
+        # t is the current step, self.t the completed ones; the untried arms are set to inf
+        # after the bonus, c * inf would be nan with c = 0
+        bonus = np.zeros(counts.shape)
+        np.divide(np.log(self.t + 1), counts, out=bonus, where=counts > 0)
+        np.sqrt(bonus, out=bonus)
+
+        return random_argmax(np.where(counts == 0, np.inf, self.action_value_table + self.c * bonus),
+                             self.rng)
+
+
+class GradientBandit(BanditOptimization):
+    """
+    numerical preferences H_t(a), actions from the soft-max distribution pi_t(a)
+    H_{t+1}(A_t) = H_t(A_t) + alpha (R_t - mean(R_t)) (1 - pi_t(A_t))
+    H_{t+1}(a) = H_t(a) - alpha (R_t - mean(R_t)) pi_t(a) for all a != A_t
+    the baseline mean(R_t) includes the present reward, it can be turned off to see the
+    difference of figure 2.5
+
+    a step allocates no array: the softmax, the cdf, the uniforms and the update are all
+    computed into buffers made once with out=. pi_t is exp(H - max H) normalized, so
+    exp never overflows however large alpha makes the preferences; the preferences of a
+    run always sum to 0, the update moves them by adv (1 - pi(A)) - adv sum pi(a != A) = 0.
+    the actions returned by choose_action are a buffer overwritten at the next call
+    """
+    def __init__(self, n: int = 10, num_envs: int = 1, alpha: float = 0.1, baseline: bool = True,
+                 seed=None):
+        self.baseline = baseline
+        self.preferences = np.empty((num_envs, n))
+        self.policy = np.empty((num_envs, n))
+        self.mean_reward = np.empty(num_envs)
+
+        # work buffers of a step
+        self._cdf = np.empty((num_envs, n))
+        self._below = np.empty((num_envs, n), dtype=bool)
+        self._column = np.empty((num_envs, 1))
+        self._actions = np.empty(num_envs, dtype=np.intp)
+        self._flat = np.empty(num_envs, dtype=np.intp)
+        self._selected = np.empty(num_envs)
+        self._advantage = np.empty(num_envs)
+        self._offsets = np.arange(num_envs) * n
+        super().__init__(n, num_envs, 0., alpha, False, 0., seed)
+
+    def reset(self):
+        """
+        H_1(a) = 0, all actions equally probable
+        """
+        super().reset()
+        self.preferences.fill(0)
+        self.policy.fill(1 / self.arms_number)
+        self.mean_reward.fill(0)
+
+    @Instrumentation.timed("bandit.choose_action")
+    def choose_action(self):
+        """
+        sample the actions of all runs from pi_t by inverse cdf: A is the number of
+        cdf values <= u, u uniform in [0, cdf(k)), with cdf(k) = 1 up to rounding
+        :return: (B,) actions, overwritten by the next call
+        """
+        policy, column = self.policy, self._column
+        np.max(self.preferences, axis=1, keepdims=True, out=column)
+        np.subtract(self.preferences, column, out=policy)
+        np.exp(policy, out=policy)
+        np.sum(policy, axis=1, keepdims=True, out=column)
+        np.divide(policy, column, out=policy)
+
+        np.cumsum(policy, axis=1, out=self._cdf)
+        self.rng.random(out=column)
+        np.multiply(column, self._cdf[:, -1:], out=column)
+        np.less_equal(self._cdf, column, out=self._below)
+        np.sum(self._below, axis=1, out=self._actions)
+        np.minimum(self._actions, self.arms_number - 1, out=self._actions)
+
+        return self._actions
+
+    @Instrumentation.timed("bandit.action_value_update")
+    def action_value_update(self, actions, rewards):
+        """
+        gradient ascent step on the preferences of every run, with pi_t of the last
+        choose_action. the pulled arms are read and written through their flat index with
+        take and put, no fancy indexing temporaries (mode="wrap" only skips the copy take
+        makes to check the bounds, the indices are always in range)
+        :param actions: (B,) pulled arms
+        :param rewards: (B,) rewards received
+        """
+        self.t += 1
+        advantage, selected, flat = self._advantage, self._selected, self._flat
+        np.add(self._offsets, actions, out=flat)
+
+        counts = self.action_counts.reshape(-1)
+        np.take(counts, flat, out=selected, mode="wrap")
+        selected += 1
+        np.put(counts, flat, selected)
+
+        if self.baseline:
+            np.subtract(rewards, self.mean_reward, out=advantage)
+            advantage /= self.t
+            self.mean_reward += advantage
+
+        np.subtract(rewards, self.mean_reward, out=advantage)
+        advantage *= self.alpha
+
+        # H(a) -= adv pi(a) for every arm, then H(A) += adv
+        np.multiply(self.policy, advantage[:, None], out=self._cdf)
+        self.preferences -= self._cdf
+        preferences = self.preferences.reshape(-1)
+        np.take(preferences, flat, out=selected, mode="wrap")
+        selected += advantage
+        np.put(preferences, flat, selected)
+
+
+def bandit_experiment(env: BanditEnv, agent: BanditOptimization, steps: int = 1000,
+                      runs: int = None):
+    """
+    run the agent on the testbeds for the given steps, starting from fresh means and tables.
+    only the running sums over the runs are kept, never a (runs x steps) history, so runs
+    larger than the batch are done one batch of env.num_envs runs at a time with O(steps)
+    memory
+    :param env: batched environment
+    :param agent: agent with the same num_envs of the environment
+    :param steps: number of pulls for each run
+    :param runs: total number of runs, rounded up to a multiple of env.num_envs; one batch
+    by default
+    :return: the mean reward over the runs and the fraction of runs choosing the optimal
+    arm, both for every step
+    """
+    batches = 1 if runs is None else -(-runs // env.num_envs)
+
+    avg_reward = np.zeros(steps)
+    optimal_action = np.zeros(steps)
+
+    for _ in range(batches):
+        env.reset()
+        agent.reset()
+
+        for t in range(steps):
+            actions = agent.choose_action()
+            # the optimal arm can move in a non-stationary env, take it before the pull
+            optimal_action[t] += np.count_nonzero(actions == env.optimal_actions)
+            rewards = env.lever_pull(actions)
+            agent.action_value_update(actions, rewards)
+
+            avg_reward[t] += rewards.sum()
+
+    avg_reward /= batches * env.num_envs
+    optimal_action /= batches * env.num_envs
+
+    return avg_reward, optimal_action
+
+
+# agent name -> (class, fixed keyword arguments), the names used by the parameter study
+BANDIT_AGENTS = {
+    "eps-greedy": (BanditOptimization, {}),
+    "optimistic": (BanditOptimization, {"alpha": 0.1}),
+    "UCB": (UCBBandit, {}),
+    "gradient": (GradientBandit, {}),
+}
+
+# grid of the page 63 parameter study: agent -> (parameter, log-spaced values)
+PARAMETER_GRID = {
+    "eps-greedy": ("epsilon", 2. ** np.arange(-7, -1)),
+    "gradient": ("alpha", 2. ** np.arange(-5, 2)),
+    "UCB": ("c", 2. ** np.arange(-4, 3)),
+    "optimistic": ("q1", 2. ** np.arange(-2, 3)),
+}
+
+
+def _study_key(agent: str, params: dict, k: int, steps: int, runs: int, seed: int):
+    """
+    identity of one grid point, its hash names the cache file and seeds the point so that the
+    result does not depend on the other points of the grid or on their order
+    """
+    key = {"agent": agent, "params": {p: float(v) for p, v in sorted(params.items())},
+           "k": k, "steps": steps, "runs": runs, "seed": seed}
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _study_point(agent: str, params: dict, k: int, steps: int, runs: int, seed: int, digest: str):
+    """
+    one independent experiment of the parameter study, run inside a worker process
+    :return: mean reward and fraction of optimal actions for every step
+    """
+    env_seed, agent_seed = np.random.SeedSequence([seed, int(digest[:16], 16)]).spawn(2)
+    agent_class, fixed = BANDIT_AGENTS[agent]
+
+    env = BanditEnv(n=k, num_envs=runs, seed=np.random.default_rng(env_seed))
+    bandit = agent_class(n=k, num_envs=runs, seed=np.random.default_rng(agent_seed),
+                         **{**fixed, **params})
+
+    return bandit_experiment(env, bandit, steps)
+
+
+def parameter_study(grid: dict = None, k: int = 10, steps: int = 1000, runs: int = 2000,
+                    seed: int = 0, cache_dir: str = "bandit_cache", max_workers: int = None):
+    """
+    average reward over the first steps for every agent and every value of his parameter.
+    each grid point is an independent experiment of runs testbeds, the points are spread over
+    a process pool and every result is saved in cache_dir, so adding a value to the grid only
+    computes the new points. cache_dir=None disables the cache.
+    :param grid: agent -> (parameter, values), PARAMETER_GRID by default
+    :param k: number of arms
+    :param steps: number of steps of each run
+    :param runs: number of independent testbeds of each point
+    :param seed: root seed, every point gets his own stream derived from it
+    :param cache_dir: directory with one .npz file for each computed point
+    :param max_workers: size of the process pool, the number of cpus by default
+    :return: agent -> (parameter values, average reward of each value)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    grid = PARAMETER_GRID if grid is None else grid
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    points = {}
+    for agent, (param, values) in grid.items():
+        for value in values:
+            params = {param: float(value)}
+            points[(agent, float(value))] = (params, _study_key(agent, params, k, steps, runs, seed))
+
+    results = {}
+    pending = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for (agent, value), (params, digest) in points.items():
+            path = None if cache_dir is None else os.path.join(cache_dir, digest + ".npz")
+            if path is not None and os.path.exists(path):
+                with np.load(path) as cached:
+                    results[(agent, value)] = float(cached["avg_reward"].mean())
+                continue
+
+            future = pool.submit(_study_point, agent, params, k, steps, runs, seed, digest)
+            pending[future] = (agent, value, path)
+
+        for future, (agent, value, path) in pending.items():
+            avg_reward, optimal_action = future.result()
+            if path is not None:
+                np.savez(path, avg_reward=avg_reward, optimal_action=optimal_action)
+            results[(agent, value)] = float(avg_reward.mean())
+
+    return {agent: (np.asarray(values, dtype=float),
+                    np.array([results[(agent, float(v))] for v in values]))
+            for agent, (param, values) in grid.items()}
 
-    def action_value_update(self):
-        pass
 
 if __name__ == "__main__":
     """
@@ -135,5 +583,33 @@ if __name__ == "__main__":
     # Number of action selections / time periods
     N = 1000
     # Epsilon parameter for exploration and exploitation trade-off
-    eps = 0
-    Q_ta = np.zeros(k)
+    epsilons = [0, 0.1, 0.01]
+    # Number of independent games, all simulated at once
+    runs = 2000
+
+    env = BanditEnv(n=k, num_envs=runs, seed=0)
+
+    agents = {f"eps={eps}": BanditOptimization(k, runs, epsilon=eps, seed=1) for eps in epsilons}
+    agents["optimistic Q1=5, alpha=0.1"] = BanditOptimization(k, runs, alpha=0.1, q1=5, seed=1)
+    agents["UCB c=2"] = UCBBandit(k, runs, c=2, seed=1)
+    agents["gradient alpha=0.1"] = GradientBandit(k, runs, alpha=0.1, seed=1)
+
+    for name, agent in agents.items():
+        avg_reward, optimal_action = bandit_experiment(env, agent, N)
+        print(f"{name}: average reward {avg_reward.mean():.3f}, "
+              f"last step {avg_reward[-1]:.3f}, optimal action {optimal_action[-1]:.1%}")
+
+    if "study" in sys.argv:
+        for name, (values, rewards) in parameter_study(k=k, steps=N, runs=runs).items():
+            print(name, ", ".join(f"{v:g}: {r:.3f}" for v, r in zip(values, rewards)))
+
+    if "nonstationary" in sys.argv:
+        # sample average against constant step size on drifting means, exercise 2.5
+        steps = 10000
+        walk_env = NonStationaryBanditEnv(n=k, num_envs=runs, seed=0)
+        for name, agent in {"sample average": BanditOptimization(k, runs, epsilon=0.1, seed=1),
+                            "alpha=0.1": BanditOptimization(k, runs, epsilon=0.1, alpha=0.1,
+                                                            seed=1)}.items():
+            avg_reward, optimal_action = bandit_experiment(walk_env, agent, steps)
+            print(f"non-stationary {name}: last 1000 steps reward {avg_reward[-1000:].mean():.3f}, "
+                  f"optimal action {optimal_action[-1000:].mean():.1%}")
@@ -1,4 +1,47 @@
+import argparse
+import sys
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IntroRL Barto Sutton experiments")
+    commands = parser.add_subparsers(dest="command")
+
+    bench = commands.add_parser("bench", help="throughput and memory benchmarks of the algorithms")
+    bench.add_argument("--quick", action="store_true", help="smaller problem sizes")
+    bench.add_argument("--only", help="comma separated suites: startup,bandit,dp,mc,td")
+    bench.add_argument("--repeat", type=int, default=3, help="timed runs of each case")
+    bench.add_argument("--output", default="bench.json", help="JSON file of the results")
+    bench.add_argument("--baseline", default="bench_baseline.json",
+                       help="results to compare with, if the file exists")
+    bench.add_argument("--save-baseline", action="store_true",
+                       help="store these results as the baseline instead of comparing")
+    bench.add_argument("--tolerance", type=float, default=0.2,
+                       help="allowed relative slowdown before a regression is reported")
+    bench.add_argument("--instrument", metavar="PREFIX",
+                       help="record the phases, written to PREFIX.json and PREFIX.trace.json "
+                            "(the timings then include the recording)")
+    bench.add_argument("--profile", metavar="PATH",
+                       help="run under cProfile and tracemalloc, stats saved to PATH")
+
+    run = commands.add_parser("run", help="run the jobs of an experiment config, see Experiments")
+    run.add_argument("config", help="JSON file with the experiments")
+    run.add_argument("--manifest", default="manifest.jsonl",
+                     help="JSONL record of the finished jobs, they are skipped when run again")
+    run.add_argument("--workers", type=int, default=None, help="processes, the number of cpus by default")
+    run.add_argument("--max-pending", type=int, default=None,
+                     help="jobs submitted to the pool at once, twice the workers by default")
+
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    print(":)")
\ No newline at end of file
+    args = parse_args()
+
+    if args.command == "bench":
+        import Benchmark
+        sys.exit(Benchmark.main(args))
+    if args.command == "run":
+        import Experiments
+        sys.exit(Experiments.main(args))
+
+    print(":)")